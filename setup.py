@@ -32,6 +32,9 @@ setup(
     [console_scripts]
     flask-ctl = presence_analyzer.script:run
     update-xml = presence_analyzer.script:update_xml
+    benchmark = presence_analyzer.benchmark:run
+    build-snapshot = presence_analyzer.script:build_snapshot
+    import-sqlite = presence_analyzer.script:import_sqlite
 
     [paste.app_factory]
     main = presence_analyzer.script:make_app
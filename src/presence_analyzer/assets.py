@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Compression of responses and fingerprinted static assets.
+"""
+
+import mimetypes
+import os
+import zlib
+from hashlib import md5
+from threading import Lock
+
+COMPRESS_MIN_SIZE = 500  # Smaller bodies aren't worth compressing.
+COMPRESS_LEVEL = 6
+COMPRESSIBLE_TYPES = (
+    'application/javascript',
+    'application/json',
+    'application/x-ndjson',
+    'image/svg+xml',
+    'text/',
+)
+ENCODINGS = ('gzip', 'deflate')
+
+
+def compressor(encoding, level=COMPRESS_LEVEL):
+    """
+    Creates zlib compression object producing given content-coding.
+
+    HTTP 'deflate' is zlib format, 'gzip' needs gzip header and trailer.
+    """
+    if encoding == 'gzip':
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return zlib.compressobj(level)
+
+
+def compress(body, encoding, level=COMPRESS_LEVEL):
+    """
+    Compresses whole body with given content-coding.
+    """
+    compression = compressor(encoding, level)
+    return compression.compress(body) + compression.flush()
+
+
+def compress_stream(chunks, encoding):
+    """
+    Compresses streamed body chunk by chunk.
+    """
+    compression = compressor(encoding)
+    for chunk in chunks:
+        compressed = compression.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compression.flush()
+
+
+def is_compressible(mimetype):
+    """
+    Checks if content of given type is text worth compressing.
+    """
+    return mimetype is not None and mimetype.startswith(COMPRESSIBLE_TYPES)
+
+
+class Asset(object):
+    """
+    Static file kept in memory with its precompressed variants.
+    """
+
+    def __init__(self, filename, content):
+        self.filename = filename
+        self.content = content
+        self.digest = md5(content).hexdigest()
+        self.mimetype = (
+            mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        )
+        root, extension = os.path.splitext(filename)
+        self.fingerprinted = '{}.{}{}'.format(
+            root, self.digest[:12], extension
+        )
+        self.variants = {}
+        if (
+                is_compressible(self.mimetype) and
+                len(content) >= COMPRESS_MIN_SIZE
+        ):
+            for encoding in ENCODINGS:
+                compressed = compress(content, encoding, level=9)
+                if len(compressed) < len(content):
+                    self.variants[encoding] = compressed
+
+
+class AssetManifest(object):
+    """
+    Fingerprinted names and precompressed variants of static files.
+
+    Every file of static folder is read once, its fingerprinted name
+    contains hash of the content, eg. 'css/style.0123456789ab.css', so it
+    can be cached by browsers forever.
+    """
+
+    def __init__(self, static_folder):
+        self.static_folder = static_folder
+        self.lock = Lock()
+        self.by_filename = None
+        self.by_fingerprint = None
+
+    def build(self):
+        """
+        Reads and compresses all static files.
+        """
+        by_filename = {}
+        for directory, _, filenames in os.walk(self.static_folder):
+            for name in filenames:
+                path = os.path.join(directory, name)
+                filename = os.path.relpath(path, self.static_folder)
+                filename = filename.replace(os.sep, '/')
+                with open(path, 'rb') as assetfile:
+                    by_filename[filename] = Asset(filename, assetfile.read())
+        self.by_fingerprint = dict(
+            (asset.fingerprinted, asset) for asset in by_filename.values()
+        )
+        self.by_filename = by_filename
+
+    def _ensure_built(self):
+        """
+        Builds manifest on first use.
+        """
+        if self.by_filename is None:
+            with self.lock:
+                if self.by_filename is None:
+                    self.build()
+
+    def fingerprinted(self, filename):
+        """
+        Returns fingerprinted name of static file or None if it's unknown.
+        """
+        self._ensure_built()
+        asset = self.by_filename.get(filename)
+        return asset.fingerprinted if asset is not None else None
+
+    def get(self, fingerprinted):
+        """
+        Returns Asset of fingerprinted name or None.
+        """
+        self._ensure_built()
+        return self.by_fingerprint.get(fingerprinted)
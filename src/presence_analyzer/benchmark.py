@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+"""
+Performance benchmarks.
+"""
+
+import argparse
+import csv
+import json
+import os.path
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import timeit
+from array import array
+from datetime import date, datetime, timedelta
+
+from flask import url_for
+
+from presence_analyzer import utils
+from presence_analyzer.loaders import parse_presence_csv
+from presence_analyzer.main import app
+from presence_analyzer.utils import seconds_since_midnight
+
+
+def parse_presence_csv_strptime(lines):
+    """
+    Reference parser: csv module and datetime.strptime for every field.
+    """
+    users, dates, starts, ends = (
+        array('i'), array('i'), array('i'), array('i')
+    )
+    for row in csv.reader(lines, delimiter=','):
+        if len(row) != 4:
+            continue
+
+        try:
+            user_id = int(row[0])
+            date = datetime.strptime(row[1], '%Y-%m-%d').date()
+            start = datetime.strptime(row[2], '%H:%M:%S').time()
+            end = datetime.strptime(row[3], '%H:%M:%S').time()
+        except (ValueError, TypeError):
+            continue
+
+        users.append(user_id)
+        dates.append(date.toordinal())
+        starts.append(seconds_since_midnight(start))
+        ends.append(seconds_since_midnight(end))
+
+    return users, dates, starts, ends
+
+
+def compare_csv_parsers(path, repeat=3):
+    """
+    Times both CSV parsers on given file.
+
+    Returns dict with best time of each parser in seconds.
+    """
+    with open(path, 'r') as csvfile:
+        lines = csvfile.readlines()
+
+    if parse_presence_csv(lines) != parse_presence_csv_strptime(lines):
+        raise AssertionError('Parsers results differ for {}'.format(path))
+
+    return {
+        'rows': len(lines),
+        'strptime': min(timeit.repeat(
+            lambda: parse_presence_csv_strptime(lines),
+            repeat=repeat,
+            number=1,
+        )),
+        'fast': min(timeit.repeat(
+            lambda: parse_presence_csv(lines),
+            repeat=repeat,
+            number=1,
+        )),
+    }
+
+
+def generate_presence_csv(path, users, years, seed=0):
+    """
+    Writes synthetic presence CSV file. Returns number of rows.
+
+    Every user is present on about 90% of workdays of the last years before
+    2014, starting between 7:00 and 11:00 and staying 6 to 10 hours.
+    The same seed gives the same file.
+    """
+    generator = random.Random(seed)
+    last = date(2013, 12, 31)
+    first = last - timedelta(days=365 * years - 1)
+    rows = 0
+    with open(path, 'w') as csvfile:
+        day = first
+        while day <= last:
+            if day.weekday() < 5:
+                for user_id in xrange(1, users + 1):
+                    if generator.random() < 0.1:
+                        continue
+                    start = generator.randint(7 * 3600, 11 * 3600)
+                    end = start + generator.randint(6 * 3600, 10 * 3600)
+                    csvfile.write('{},{},{},{}\n'.format(
+                        user_id,
+                        day.isoformat(),
+                        format_seconds(start),
+                        format_seconds(end),
+                    ))
+                    rows += 1
+            day += timedelta(days=1)
+    return rows
+
+
+def generate_users_xml(path, users, seed=0):
+    """
+    Writes synthetic users xml file with users of generate_presence_csv.
+    """
+    generator = random.Random(seed)
+    letters = u'AĄBCĆDEĘFGHIJKLŁMNŃOÓPRSŚTUWYZŹŻ'
+    with open(path, 'w') as xmlfile:
+        xmlfile.write(
+            '<intranet>\n'
+            '    <server>\n'
+            '        <host>intranet.example.com</host>\n'
+            '        <port>443</port>\n'
+            '        <protocol>https</protocol>\n'
+            '    </server>\n'
+            '    <users>\n'
+        )
+        for user_id in xrange(1, users + 1):
+            name = u'{}{} {}.'.format(
+                generator.choice(letters),
+                u''.join(
+                    generator.choice(letters).lower()
+                    for _ in xrange(generator.randint(3, 8))
+                ),
+                generator.choice(letters),
+            )
+            xmlfile.write((
+                u'        <user id="{0}">\n'
+                u'            <avatar>/api/images/users/{0}</avatar>\n'
+                u'            <name>{1}</name>\n'
+                u'        </user>\n'
+            ).format(user_id, name).encode('utf-8'))
+        xmlfile.write('    </users>\n</intranet>\n')
+
+
+def format_seconds(seconds):
+    """
+    Formats seconds since midnight as HH:MM:SS.
+    """
+    return '{:02d}:{:02d}:{:02d}'.format(
+        seconds // 3600, seconds // 60 % 60, seconds % 60
+    )
+
+
+def peak_memory():
+    """
+    Returns peak resident memory of the process in kilobytes.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def api_urls(user_id):
+    """
+    Returns url of every /api/v1/ view for given user.
+    """
+    values = {'user_id': user_id, 'metric': 'presence_weekday'}
+    urls = []
+    with app.test_request_context():
+        for rule in sorted(app.url_map.iter_rules(), key=str):
+            if not rule.rule.startswith('/api/v1/'):
+                continue
+            if not rule.arguments <= set(values):
+                continue
+            urls.append(url_for(
+                rule.endpoint,
+                **dict((name, values[name]) for name in rule.arguments)
+            ))
+    return urls
+
+
+def latency(client, url, requests):
+    """
+    Times requests of warm url. Returns min, median, p95 and max in seconds.
+    """
+    client.get(url).data  # pylint: disable=expression-not-assigned
+    times = []
+    for _ in xrange(requests):
+        start = time.time()
+        client.get(url).data  # pylint: disable=expression-not-assigned
+        times.append(time.time() - start)
+    times.sort()
+    return {
+        'min': times[0],
+        'median': times[len(times) // 2],
+        'p95': times[min(len(times) - 1, int(len(times) * 0.95))],
+        'max': times[-1],
+    }
+
+
+def throughput(urls, threads, requests):
+    """
+    Sends requests for every url from each of threads at once.
+
+    Returns number of requests per second.
+    """
+    def worker():
+        """
+        Sends requests with its own client.
+        """
+        client = app.test_client()
+        for _ in xrange(requests):
+            for url in urls:
+                client.get(url).data  # pylint: disable=expression-not-assigned
+
+    pool = [threading.Thread(target=worker) for _ in xrange(threads)]
+    start = time.time()
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    return threads * requests * len(urls) / (time.time() - start)
+
+
+def run_suite(users=100, years=2, requests=20, threads=4, seed=0):
+    """
+    Benchmarks the application on synthetic dataset.
+
+    Times cold get_data() load, latency of every warm /api/v1/ view and
+    throughput of concurrent threads. Returns results as dict.
+    """
+    tmpdir = tempfile.mkdtemp()
+    config = dict(app.config)
+    try:
+        csv_path = os.path.join(tmpdir, 'data.csv')
+        xml_path = os.path.join(tmpdir, 'users.xml')
+        rows = generate_presence_csv(csv_path, users, years, seed)
+        generate_users_xml(xml_path, users, seed)
+        app.config.update({
+            'DATA_CSV': csv_path,
+            'DATA_XML': xml_path,
+            'DATA_SNAPSHOT': None,
+            'SHARED_DATA': False,
+            'STORAGE': 'csv',
+            'CSV_WORKERS': 1,
+        })
+
+        memory_before = peak_memory()
+        start = time.time()
+        utils.get_data.reload()
+        cold_load = time.time() - start
+        memory_after = peak_memory()
+
+        client = app.test_client()
+        urls = api_urls(user_id=1)
+        return {
+            'parameters': {
+                'users': users,
+                'years': years,
+                'rows': rows,
+                'requests': requests,
+                'threads': threads,
+                'seed': seed,
+            },
+            'environment': {
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'time': datetime.utcnow().isoformat(),
+            },
+            'results': {
+                'cold_load': cold_load,
+                'peak_memory_kb': {
+                    'before_load': memory_before,
+                    'after_load': memory_after,
+                },
+                'latency': dict(
+                    (url, latency(client, url, requests)) for url in urls
+                ),
+                'throughput': throughput(urls, threads, requests),
+                'peak_memory_kb_total': peak_memory(),
+            },
+        }
+    finally:
+        app.config.clear()
+        app.config.update(config)
+        if 'DATA_CSV' in config:
+            utils.get_data.reload()
+        shutil.rmtree(tmpdir)
+
+
+def compare_results(previous, current, tolerance=0.2):
+    """
+    Lists timings of current results slower than previous ones.
+
+    Returns (name, previous, current) of every cold load, median latency
+    or throughput worse by more than tolerance.
+    """
+    regressions = []
+    before, after = previous['results'], current['results']
+    if after['cold_load'] > before['cold_load'] * (1 + tolerance):
+        regressions.append(
+            ('cold_load', before['cold_load'], after['cold_load'])
+        )
+    for url, timings in sorted(after['latency'].items()):
+        if url not in before['latency']:
+            continue
+        median = before['latency'][url]['median']
+        if timings['median'] > median * (1 + tolerance):
+            regressions.append((url, median, timings['median']))
+    if after['throughput'] < before['throughput'] * (1 - tolerance):
+        regressions.append(
+            ('throughput', before['throughput'], after['throughput'])
+        )
+    return regressions
+
+
+def run():
+    """
+    Runs benchmarks, see bin/benchmark --help.
+    """
+    parser = argparse.ArgumentParser(description=(
+        'Benchmarks application on synthetic data and writes results '
+        'to JSON file. Given CSV file CSV parsers are compared instead.'
+    ))
+    parser.add_argument('csv', nargs='?', help='compare CSV parsers on file')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--years', type=int, default=2)
+    parser.add_argument('--requests', type=int, default=20,
+                        help='requests of every view')
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--compare', metavar='PREVIOUS',
+                        help='report regressions against previous results')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    if args.csv:
+        result = compare_csv_parsers(args.csv)
+        print('{rows} rows'.format(**result))
+        print('strptime loop: {strptime:.4f}s'.format(**result))
+        print('fast parser:   {fast:.4f}s'.format(**result))
+        print('speedup:       {:.1f}x'.format(
+            result['strptime'] / result['fast']
+        ))
+        return
+
+    result = run_suite(
+        args.users, args.years, args.requests, args.threads, args.seed
+    )
+    with open(args.output, 'w') as outputfile:
+        json.dump(result, outputfile, indent=2, sort_keys=True)
+    print('{rows} rows, cold load {cold_load:.3f}s, {throughput:.0f} req/s'
+          .format(**dict(result['parameters'], **result['results'])))
+    print('results written to {}'.format(args.output))
+
+    if args.compare:
+        with open(args.compare) as previousfile:
+            previous = json.load(previousfile)
+        regressions = compare_results(previous, result, args.tolerance)
+        for name, before, after in regressions:
+            print('REGRESSION {}: {:.4f} -> {:.4f}'.format(
+                name, before, after
+            ))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+Locale independent Polish collation.
+"""
+from __future__ import unicode_literals
+
+import unicodedata
+
+POLISH_ALPHABET = 'aąbcćdeęfghijklłmnńoópqrsśtuvwxyzźż'
+POLISH_ORDER = dict(
+    (letter, rank) for rank, letter in enumerate(POLISH_ALPHABET)
+)
+
+
+def collation_element(char):
+    """
+    Returns comparable weight of single lowercase character.
+
+    Digits go before letters, letters are ordered by Polish alphabet.
+    Other accented letters follow their base letter, remaining characters
+    are ordered by code point.
+    """
+    if char in POLISH_ORDER:
+        return (1, POLISH_ORDER[char], 0)
+    if char.isdigit():
+        return (0, ord(char), 0)
+    base = unicodedata.normalize('NFD', char)[0]
+    if base in POLISH_ORDER:
+        return (1, POLISH_ORDER[base], ord(char))
+    return (2, ord(char), 0)
+
+
+def polish_sort_key(text):
+    """
+    Creates key sorting texts like pl_PL.UTF-8 collation does.
+
+    Spaces and punctuation are ignored unless texts are otherwise equal,
+    lowercase letters go before uppercase ones.
+    """
+    if isinstance(text, bytes):
+        text = text.decode('utf-8')
+    lower = text.lower()
+    return (
+        tuple(collation_element(char) for char in lower if char.isalnum()),
+        tuple(collation_element(char) for char in lower),
+        tuple(char.isupper() for char in text),
+    )
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite storage of presence data.
+
+Entries are kept in a single table with (user_id, date) primary key, which
+serves as the index of all queries. Dates are stored as ordinals, start
+and end of presence as seconds since midnight, like in PresenceStore.
+"""
+
+import datetime
+import os
+import sqlite3
+import threading
+
+from presence_analyzer.store import time_from_seconds
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS presence (
+    user_id INTEGER NOT NULL,
+    date INTEGER NOT NULL,
+    start_time INTEGER NOT NULL,
+    end_time INTEGER NOT NULL,
+    PRIMARY KEY (user_id, date)
+) WITHOUT ROWID
+"""
+
+# Expressions deriving weekday and month_key() from date ordinal.
+WEEKDAY = '(date - 1) % 7'
+MONTH = "strftime('%Y.%m', date + 1721424.5)"
+
+FIRST_DATE = datetime.date.min.toordinal()
+LAST_DATE = datetime.date.max.toordinal()
+
+
+def connect(path):
+    """
+    Opens database, creates presence table if it doesn't exist yet.
+    """
+    connection = sqlite3.connect(path)
+    connection.execute(SCHEMA)
+    return connection
+
+
+def insert_rows(connection, users, dates, starts, ends):
+    """
+    Inserts columns of rows, replaces entries for the same user and date.
+    """
+    connection.executemany(
+        'INSERT OR REPLACE INTO presence VALUES (?, ?, ?, ?)',
+        zip(users, dates, starts, ends),
+    )
+
+
+def aggregate_rows(weekday_rows, month_rows):
+    """
+    Builds result of UserPresence.aggregate() from grouped query rows.
+
+    Weekday rows are (weekday, count, start_total, end_total) tuples,
+    month rows are (month, total) tuples.
+    """
+    result = {
+        'weekday_count': [0] * 7,
+        'weekday_total': [0] * 7,
+        'start_total': [0] * 7,
+        'end_total': [0] * 7,
+        'months': {},
+    }
+    for weekday, count, start_total, end_total in weekday_rows:
+        result['weekday_count'][weekday] = count
+        result['weekday_total'][weekday] = end_total - start_total
+        result['start_total'][weekday] = start_total
+        result['end_total'][weekday] = end_total
+    for month, total in month_rows:
+        result['months'][month] = total
+    return result
+
+
+class SQLitePresenceStore(object):
+    """
+    Presence data kept in SQLite database.
+
+    It has the same interface as PresenceStore, but entries aren't loaded
+    into memory: they are read and aggregated by queries when needed.
+    Every thread and process uses its own connection.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self._aggregates = None
+        self._totals = None
+
+    def query(self, sql, *params):
+        """
+        Executes query on connection of current thread. Returns cursor.
+        """
+        # Connections mustn't be shared with forked worker processes.
+        pid = os.getpid()
+        if getattr(self.local, 'pid', None) != pid:
+            self.local.connection = sqlite3.connect(self.path)
+            self.local.pid = pid
+        return self.local.connection.execute(sql, params)
+
+    @property
+    def aggregates(self):
+        """
+        Index of UserPresence.aggregate() results by user_id.
+
+        It is computed by two grouping queries on first access.
+        """
+        if self._aggregates is None:
+            weekday_rows, month_rows = {}, {}
+            for row in self.query(
+                    'SELECT user_id, {weekday}, COUNT(*), SUM(start_time), '
+                    'SUM(end_time) FROM presence '
+                    'GROUP BY user_id, {weekday}'.format(weekday=WEEKDAY)):
+                weekday_rows.setdefault(row[0], []).append(row[1:])
+            for row in self.query(
+                    'SELECT user_id, {month}, SUM(end_time - start_time) '
+                    'FROM presence GROUP BY user_id, {month}'.format(
+                        month=MONTH)):
+                month_rows.setdefault(row[0], []).append(row[1:])
+            self._aggregates = dict(
+                (
+                    user_id,
+                    aggregate_rows(rows, month_rows.get(user_id, ())),
+                )
+                for user_id, rows in weekday_rows.iteritems()
+            )
+        return self._aggregates
+
+    @property
+    def totals(self):
+        """
+        Presence of all users summed up together like in aggregates.
+        """
+        if self._totals is None:
+            self._totals = aggregate_rows(
+                self.query(
+                    'SELECT {weekday}, COUNT(*), SUM(start_time), '
+                    'SUM(end_time) FROM presence '
+                    'GROUP BY {weekday}'.format(weekday=WEEKDAY)
+                ),
+                self.query(
+                    'SELECT {month}, SUM(end_time - start_time) '
+                    'FROM presence GROUP BY {month}'.format(month=MONTH)
+                ),
+            )
+        return self._totals
+
+    def user_aggregates(self, user_id, first=None, last=None):
+        """
+        Returns aggregates of user's presence from first to last date ordinal.
+        """
+        return self[user_id].between(first, last).aggregate()
+
+    def start_histogram(self, width, count):
+        """
+        Counts entries started in each of count periods of width seconds.
+        """
+        result = [0] * count
+        for bucket, entries in self.query(
+                'SELECT start_time / ?, COUNT(*) FROM presence '
+                'WHERE start_time >= 0 AND start_time < ? '
+                'GROUP BY 1', width, width * count):
+            result[bucket] = entries
+        return result
+
+    def __contains__(self, user_id):
+        return self.query(
+            'SELECT 1 FROM presence WHERE user_id = ? LIMIT 1', user_id
+        ).fetchone() is not None
+
+    def __getitem__(self, user_id):
+        if user_id not in self:
+            raise KeyError(user_id)
+        return SQLiteUserPresence(self, user_id)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return self.query(
+            'SELECT COUNT(DISTINCT user_id) FROM presence'
+        ).fetchone()[0]
+
+    def keys(self):
+        """
+        Returns list of user ids.
+        """
+        return [
+            row[0] for row in self.query(
+                'SELECT DISTINCT user_id FROM presence ORDER BY user_id'
+            )
+        ]
+
+
+class SQLiteUserPresence(object):
+    """
+    Read-only view of single user's entries in SQLite database.
+
+    It has the same interface as UserPresence, entries are limited to dates
+    from first to last ordinal inclusive.
+    """
+
+    def __init__(self, store, user_id, first=None, last=None):
+        self.store = store
+        self.user_id = user_id
+        self.first = FIRST_DATE if first is None else first
+        self.last = LAST_DATE if last is None else last
+
+    def query(self, sql, *params):
+        """
+        Executes query with WHERE clause selecting entries of the view.
+
+        The clause is put in place of {where} in sql.
+        """
+        return self.store.query(
+            sql.format(where='user_id = ? AND date BETWEEN ? AND ?'),
+            self.user_id, self.first, self.last, *params
+        )
+
+    def between(self, first=None, last=None):
+        """
+        Returns view of entries from first to last date ordinal inclusive.
+        """
+        return SQLiteUserPresence(
+            self.store,
+            self.user_id,
+            self.first if first is None else max(self.first, first),
+            self.last if last is None else min(self.last, last),
+        )
+
+    def entries(self):
+        """
+        Yields (date ordinal, start, end) of user's entries one by one.
+        """
+        return iter(self.query(
+            'SELECT date, start_time, end_time FROM presence '
+            'WHERE {where} ORDER BY date'
+        ))
+
+    def aggregate(self):
+        """
+        Sums up user's presence, see UserPresence.aggregate().
+        """
+        return aggregate_rows(
+            self.query(
+                'SELECT {weekday}, COUNT(*), SUM(start_time), SUM(end_time) '
+                'FROM presence WHERE {{where}} '
+                'GROUP BY {weekday}'.format(weekday=WEEKDAY)
+            ),
+            self.query(
+                'SELECT {month}, SUM(end_time - start_time) FROM presence '
+                'WHERE {{where}} GROUP BY {month}'.format(month=MONTH)
+            ),
+        )
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, SQLiteUserPresence) and
+            self.store is other.store and
+            (self.user_id, self.first, self.last) ==
+            (other.user_id, other.first, other.last)
+        )
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self.store), self.user_id, self.first, self.last))
+
+    def __contains__(self, date):
+        return self.query(
+            'SELECT 1 FROM presence WHERE {where} AND date = ?',
+            date.toordinal(),
+        ).fetchone() is not None
+
+    def __getitem__(self, date):
+        row = self.query(
+            'SELECT start_time, end_time FROM presence '
+            'WHERE {where} AND date = ?',
+            date.toordinal(),
+        ).fetchone()
+        if row is None:
+            raise KeyError(date)
+        return {
+            'start': time_from_seconds(row[0]),
+            'end': time_from_seconds(row[1]),
+        }
+
+    def __iter__(self):
+        return (
+            datetime.date.fromordinal(row[0]) for row in self.query(
+                'SELECT date FROM presence WHERE {where} ORDER BY date'
+            )
+        )
+
+    def __len__(self):
+        return self.query(
+            'SELECT COUNT(*) FROM presence WHERE {where}'
+        ).fetchone()[0]
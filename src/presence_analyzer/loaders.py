@@ -0,0 +1,675 @@
+# -*- coding: utf-8 -*-
+"""
+Loaders of presence CSV file, its snapshots and database and of users xml.
+
+Every loader remembers what it has read and reads files again only when
+they change, module level instances of them are kept in utils.
+"""
+
+import fcntl
+import logging
+import multiprocessing
+import os
+import time
+import urllib2
+from array import array
+from datetime import date as date_type, datetime
+from io import BytesIO
+from itertools import islice
+from json import dump, load
+from threading import Event, Lock, Thread
+
+from lxml import etree
+
+from presence_analyzer import database, metrics
+from presence_analyzer.collation import polish_sort_key
+from presence_analyzer.snapshot import (
+    file_checksum,
+    map_snapshot,
+    read_snapshot,
+    replace_file,
+    write_snapshot,
+)
+from presence_analyzer.store import PresenceStore
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+LOAD_SECONDS = metrics.Histogram(
+    'presence_load_seconds',
+    'Time of loading datasets.',
+    ('dataset',),
+)
+
+
+class PresenceCSVLoader(object):
+    """
+    Loads presence CSV file and afterwards reads only the appended rows.
+
+    The file is expected to be append-only. Loader remembers identity
+    (device and inode), size, mtime and byte offset of the last complete
+    line it has read. When the file was truncated, rotated or rewritten
+    in place the whole file is loaded again.
+
+    Instead of parsing the whole file loader can start from a snapshot
+    made of this file or of its beginning.
+
+    With more than one worker the file is split into chunks of whole
+    lines parsed by a pool of processes, see parse_presence_csv_parallel.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.path = None
+        self.identity = None
+        self.size = 0
+        self.mtime = None
+        self.offset = 0
+        self.data = None
+
+    def load(self, path, snapshot_path=None, workers=1, force=False):
+        """
+        Returns PresenceStore with current content of given file.
+
+        With force whole file is parsed even if it hasn't changed.
+        """
+        with self.lock, open(path, 'r') as csvfile:
+            if force:
+                self.identity = None
+                self.offset = 0
+                snapshot_path = None
+            stat = os.fstat(csvfile.fileno())
+            if (
+                    snapshot_path and
+                    not self._is_unchanged(path, stat) and
+                    not self._is_appended(path, stat, csvfile)
+            ):
+                self._restore(path, stat, csvfile, snapshot_path)
+            if self._is_unchanged(path, stat):
+                return self.data
+
+            appended = self._is_appended(path, stat, csvfile)
+            if appended:
+                log.debug('Reading %s from byte %d', path, self.offset)
+            else:
+                log.debug('Reading whole %s', path)
+                self.path = path
+                self.identity = (stat.st_dev, stat.st_ino)
+                self.offset = 0
+
+            if workers > 1:
+                columns, size, offset = parse_presence_csv_parallel(
+                    path, self.offset, stat.st_size, workers
+                )
+            else:
+                csvfile.seek(self.offset)
+                chunk = csvfile.read()
+                columns = parse_presence_csv(chunk.splitlines())
+                size = self.offset + len(chunk)
+                offset = self.offset + chunk.rfind('\n') + 1
+            if appended:
+                self.data = self.data.merge(*columns)
+            else:
+                self.data = PresenceStore.from_columns(*columns)
+            self.size = size
+            self.mtime = stat.st_mtime
+            # Unterminated last line is read again on the next load.
+            self.offset = offset
+            return self.data
+
+    def _restore(self, path, stat, csvfile, snapshot_path):
+        """
+        Takes data from snapshot if it was made of given file.
+
+        Snapshot is trusted when size and mtime of the file are equal to
+        the recorded ones, otherwise recorded checksum has to match the
+        beginning of the file.
+        """
+        try:
+            header, data = read_snapshot(snapshot_path)
+        except (IOError, ValueError):
+            log.info('Cannot read snapshot %s', snapshot_path, exc_info=True)
+            return
+
+        if stat.st_size < header['size']:
+            return
+        mtime = header['mtime']
+        if (stat.st_size, stat.st_mtime) != (header['size'], mtime):
+            if file_checksum(csvfile, header['size']) != header['checksum']:
+                log.info('Snapshot %s is out of date', snapshot_path)
+                return
+            if stat.st_size == header['size']:
+                mtime = stat.st_mtime
+
+        log.debug('Restored %s from %s', path, snapshot_path)
+        self.path = path
+        self.identity = (stat.st_dev, stat.st_ino)
+        self.size = header['size']
+        self.mtime = mtime
+        self.offset = header['offset']
+        self.data = data
+
+    def source(self, csvfile):
+        """
+        Describes loaded part of given file for a snapshot.
+        """
+        return {
+            'size': self.size,
+            'mtime': self.mtime,
+            'offset': self.offset,
+            'checksum': file_checksum(csvfile, self.size),
+        }
+
+    def _is_unchanged(self, path, stat):
+        """
+        Checks if file wasn't modified since the last load.
+        """
+        return (
+            self.data is not None and
+            path == self.path and
+            (stat.st_dev, stat.st_ino) == self.identity and
+            stat.st_size == self.size and
+            stat.st_mtime == self.mtime
+        )
+
+    def _is_appended(self, path, stat, csvfile):
+        """
+        Checks if file was only extended since the last load.
+        """
+        if (
+                self.data is None or
+                path != self.path or
+                (stat.st_dev, stat.st_ino) != self.identity or
+                stat.st_size <= self.size
+        ):
+            return False
+        if self.offset == 0:
+            return True
+        csvfile.seek(self.offset - 1)
+        return csvfile.read(1) == '\n'
+
+
+class SharedSnapshotLoader(object):
+    """
+    Keeps presence data in snapshot file mapped by all worker processes.
+
+    Every process maps the current snapshot and switches to a new one as
+    soon as it replaces the file. When snapshot is older than CSV file one
+    of the processes, holding the lock file, brings it up to date and
+    publishes it while the others keep using the previous one.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.identity = None
+        self.header = None
+        self.data = None
+
+    def load(self, csv_path, snapshot_path, workers=1, force=False):
+        """
+        Returns PresenceStore mapped from up to date snapshot of CSV file.
+
+        With force snapshot is built again from whole CSV file.
+        """
+        with self.lock:
+            self._attach(snapshot_path)
+            if force or not self._is_fresh(csv_path):
+                self._publish(
+                    csv_path, snapshot_path, workers,
+                    blocking=force or self.data is None, force=force,
+                )
+                self._attach(snapshot_path)
+            return self.data
+
+    def _attach(self, snapshot_path):
+        """
+        Maps snapshot file unless it is already mapped.
+        """
+        try:
+            stat = os.stat(snapshot_path)
+        except OSError:
+            return
+        identity = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime)
+        if identity == self.identity:
+            return
+        try:
+            self.header, self.data = map_snapshot(snapshot_path)
+        except (IOError, ValueError):
+            log.warning('Cannot map %s', snapshot_path, exc_info=True)
+            return
+        self.identity = identity
+        log.debug('Mapped %s', snapshot_path)
+
+    def _is_fresh(self, csv_path):
+        """
+        Checks if mapped snapshot was made of current CSV file.
+        """
+        if self.header is None:
+            return False
+        stat = os.stat(csv_path)
+        return (
+            (stat.st_size, stat.st_mtime) ==
+            (self.header['size'], self.header['mtime'])
+        )
+
+    def _publish(self, csv_path, snapshot_path, workers, blocking,
+                 force=False):
+        """
+        Writes new snapshot, unless other process is already doing it.
+        """
+        with open(snapshot_path + '.lock', 'a') as lockfile:
+            operation = fcntl.LOCK_EX
+            if not blocking:
+                operation |= fcntl.LOCK_NB
+            try:
+                fcntl.flock(lockfile, operation)
+            except IOError:
+                return
+            try:
+                self._attach(snapshot_path)
+                if force:
+                    build_snapshot(csv_path, snapshot_path, workers=workers)
+                elif not self._is_fresh(csv_path):
+                    # Only appended rows are parsed if the old snapshot
+                    # still matches the beginning of the file.
+                    build_snapshot(
+                        csv_path, snapshot_path, snapshot_path, workers
+                    )
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+class SQLiteLoader(object):
+    """
+    Opens SQLite presence database and opens it again when file changes.
+
+    Store is replaced after every modification of the database, so that
+    cached results depending on get_data are dropped.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.stamp = None
+        self.data = None
+
+    def load(self, path, force=False):
+        """
+        Returns SQLitePresenceStore of given database.
+
+        With force database is opened again even if it hasn't changed.
+        """
+        with self.lock:
+            stat = os.stat(path)
+            stamp = (
+                path, stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime
+            )
+            if force or stamp != self.stamp:
+                log.debug('Opening %s', path)
+                self.data = database.SQLitePresenceStore(path)
+                self.stamp = stamp
+            return self.data
+
+
+def import_sqlite(csv_path, db_path, batch=10000):
+    """
+    Imports CSV file into SQLite database. Returns number of rows.
+
+    Rows are parsed and inserted batch by batch in a single transaction.
+    Entries for the same user and date are replaced, like in CSV loaders.
+    """
+    rows = 0
+    connection = database.connect(db_path)
+    try:
+        with connection, open(csv_path, 'r') as csvfile:
+            while True:
+                lines = list(islice(csvfile, batch))
+                if not lines:
+                    break
+                columns = parse_presence_csv(lines)
+                database.insert_rows(connection, *columns)
+                rows += len(columns[0])
+    finally:
+        connection.close()
+    return rows
+
+
+def build_snapshot(csv_path, snapshot_path, previous_path=None, workers=1):
+    """
+    Parses CSV file and writes its snapshot. Returns number of rows.
+
+    When previous snapshot is given it is used to skip parsing.
+    """
+    loader = PresenceCSVLoader()
+    data = loader.load(csv_path, previous_path, workers)
+    with open(csv_path, 'r') as csvfile:
+        write_snapshot(snapshot_path, data, loader.source(csvfile))
+    return len(data.dates)
+
+
+def parse_presence_csv(lines):
+    """
+    Parses presence rows in 'id,YYYY-MM-DD,HH:MM:SS,HH:MM:SS' format.
+
+    Dates and times are sliced at fixed offsets instead of going through
+    datetime.strptime, and every distinct date or time string is parsed
+    only once. Returns users, dates, starts and ends columns.
+    """
+    users, dates, starts, ends = (
+        array('i'), array('i'), array('i'), array('i')
+    )
+    ordinals = {}
+    seconds = {}
+    for i, line in enumerate(lines):
+        row = line.rstrip('\r\n').split(',')
+        if len(row) != 4:
+            # ignore header and footer lines
+            continue
+
+        try:
+            user_id = int(row[0])
+            date = ordinals.get(row[1])
+            if date is None:
+                date = ordinals[row[1]] = parse_date(row[1])
+            start = seconds.get(row[2])
+            if start is None:
+                start = seconds[row[2]] = parse_time(row[2])
+            end = seconds.get(row[3])
+            if end is None:
+                end = seconds[row[3]] = parse_time(row[3])
+        except (ValueError, TypeError):
+            log.debug('Problem with line %d: ', i, exc_info=True)
+            continue
+
+        users.append(user_id)
+        dates.append(date)
+        starts.append(start)
+        ends.append(end)
+
+    return users, dates, starts, ends
+
+
+def chunk_boundaries(csvfile, begin, end, count):
+    """
+    Splits bytes from begin to end of file into about count chunks.
+
+    Every boundary but the last one is placed just after a newline, begin
+    is expected to be a start of line. Returns list of chunk boundaries.
+    """
+    boundaries = [begin]
+    for i in xrange(1, count):
+        position = begin + (end - begin) * i // count
+        if position <= boundaries[-1]:
+            continue
+        csvfile.seek(position - 1)
+        csvfile.readline()
+        position = csvfile.tell()
+        if boundaries[-1] < position < end:
+            boundaries.append(position)
+    boundaries.append(end)
+    return boundaries
+
+
+def parse_presence_csv_chunk(chunk):
+    """
+    Parses bytes from begin to end of file, chunk is (path, begin, end).
+
+    Returns columns like parse_presence_csv and offset just after the last
+    newline of the chunk.
+    """
+    path, begin, end = chunk
+    with open(path, 'r') as csvfile:
+        csvfile.seek(begin)
+        content = csvfile.read(end - begin)
+    columns = parse_presence_csv(content.splitlines())
+    return columns, begin + content.rfind('\n') + 1
+
+
+def parse_presence_csv_parallel(path, begin, end, workers):
+    """
+    Parses CSV file from begin to end byte in a pool of processes.
+
+    File is split into line-aligned chunks, columns of parsed chunks are
+    joined in file order, so they are equal to parse_presence_csv result.
+    Returns the columns, end and offset just after the last newline.
+
+    Forking a process with running threads may deadlock on locks held
+    by them, so it's called only by commands and before serving.
+    """
+    with open(path, 'r') as csvfile:
+        boundaries = chunk_boundaries(csvfile, begin, end, workers * 4)
+    chunks = [
+        (path, boundaries[i], boundaries[i + 1])
+        for i in xrange(len(boundaries) - 1)
+    ]
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = pool.map(parse_presence_csv_chunk, chunks)
+    finally:
+        pool.close()
+        pool.join()
+
+    columns = (array('i'), array('i'), array('i'), array('i'))
+    offset = begin
+    for chunk_columns, chunk_offset in results:
+        for column, chunk_column in zip(columns, chunk_columns):
+            column.extend(chunk_column)
+        offset = max(offset, chunk_offset)
+    return columns, end, offset
+
+
+def parse_date(value):
+    """
+    Converts 'YYYY-MM-DD' string to date ordinal.
+    """
+    if len(value) == 10 and value[4] == value[7] == '-':
+        return date_type(
+            int(value[:4]), int(value[5:7]), int(value[8:])
+        ).toordinal()
+    return datetime.strptime(value, '%Y-%m-%d').toordinal()
+
+
+def parse_time(value):
+    """
+    Converts 'HH:MM:SS' string to amount of seconds since midnight.
+    """
+    if len(value) == 8 and value[2] == value[5] == ':':
+        hour, minute, second = int(value[:2]), int(value[3:5]), int(value[6:])
+        if not (0 <= hour < 24 and 0 <= minute < 60 and 0 <= second < 60):
+            raise ValueError('Invalid time: {}'.format(value))
+    else:
+        parsed = datetime.strptime(value, '%H:%M:%S')
+        hour, minute, second = parsed.hour, parsed.minute, parsed.second
+    return hour * 3600 + minute * 60 + second
+
+
+def parse_users_xml(xmlfile):
+    """
+    Parses users xml file into {user_id: {'user_name', 'avatar'}} dict.
+    """
+    xml_data = {}
+    tree = etree.parse(xmlfile)
+    server = tree.find('server')
+    server_data = '{}://{}'.format(
+        server.find('protocol').text,
+        server.find('host').text
+    )
+
+    users = tree.find('users')
+    users = users.findall('user')
+
+    for user in users:
+        user_id = user.get('id')
+        user_name = user.find('name').text
+        user_avatar = user.find('avatar').text
+        avatar = '{}{}'.format(server_data, user_avatar)
+        xml_data[user_id] = {'user_name': user_name, 'avatar': avatar}
+
+    return xml_data
+
+
+class UserDirectory(object):
+    """
+    Users from xml file with lookups prepared for the views.
+
+    User list is sorted by name in Polish alphabetical order.
+    """
+
+    def __init__(self, users):
+        self.users = users
+        self.user_list = sorted(
+            (
+                {'user_id': user_id, 'name': user['user_name']}
+                for user_id, user in users.iteritems()
+            ),
+            key=lambda user: polish_sort_key(user['name']),
+        )
+
+
+class UsersXMLLoader(object):
+    """
+    Keeps UserDirectory of users xml file, reloads it when file changes.
+
+    File is considered changed when its identity (device and inode), size
+    or mtime differ from the loaded one.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.loaded = (None, None)
+        self.version = 0
+        self.modified = None
+
+    def load(self, path, force=False):
+        """
+        Returns UserDirectory with current content of given file.
+
+        With force the file is read even if it hasn't changed.
+        """
+        stat = os.stat(path)
+        stamp = (path, stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime)
+        if self.loaded[0] == stamp and not force:
+            return self.loaded[1]
+
+        with self.lock:
+            if self.loaded[0] != stamp or force:
+                log.debug('Reading %s', path)
+                with LOAD_SECONDS.time('users_xml'), open(path) as xmlfile:
+                    directory = UserDirectory(parse_users_xml(xmlfile))
+                self.loaded = (stamp, directory)
+                self.version += 1
+                self.modified = time.time()
+            return self.loaded[1]
+
+    def current_version(self):
+        """
+        Returns number of loads, which changes with the data.
+        """
+        return self.version
+
+    def current_modified(self):
+        """
+        Returns UTC time of the last load, None before the first one.
+        """
+        if self.modified is None:
+            return None
+        return datetime.utcfromtimestamp(int(self.modified))
+
+
+class UsersXMLRefresher(object):
+    """
+    Downloads users xml file from url and replaces local copy of it.
+
+    Requests are conditional: ETag and Last-Modified of the previous
+    download, kept in '<path>.validators' file, are sent back, so unchanged
+    file costs only 304 Not Modified response. Downloaded file has to be
+    a valid users file, it is written to a temporary file and renamed over
+    the old one, so readers never see it partially written. Afterwards
+    loader, if given, reads the new file.
+    """
+
+    def __init__(self, url, path, timeout=10, loader=None):
+        self.url = url
+        self.path = path
+        self.timeout = timeout
+        self.loader = loader
+        self.validators_path = path + '.validators'
+        self.stopping = Event()
+        self.thread = None
+
+    def refresh(self):
+        """
+        Downloads file if it has changed. Returns True when it was replaced.
+        """
+        xml_request = urllib2.Request(self.url)
+        validators = self._validators()
+        if validators.get('etag'):
+            xml_request.add_header('If-None-Match', validators['etag'])
+        if validators.get('last_modified'):
+            xml_request.add_header(
+                'If-Modified-Since', validators['last_modified']
+            )
+        try:
+            response = urllib2.urlopen(xml_request, timeout=self.timeout)
+        except urllib2.HTTPError as error:
+            if error.code == 304:
+                log.debug('%s not modified', self.url)
+                return False
+            raise
+        try:
+            content = response.read()
+            headers = response.info()
+        finally:
+            response.close()
+
+        parse_users_xml(BytesIO(content))
+        with replace_file(self.path) as xmlfile:
+            xmlfile.write(content)
+        with replace_file(self.validators_path) as validators_file:
+            dump({
+                'etag': headers.get('ETag'),
+                'last_modified': headers.get('Last-Modified'),
+            }, validators_file)
+        log.info('Downloaded %s to %s', self.url, self.path)
+        if self.loader is not None:
+            self.loader.load(self.path)
+        return True
+
+    def _validators(self):
+        """
+        Returns validators of the last download, if its file still exists.
+        """
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.validators_path, 'r') as validators_file:
+                return load(validators_file)
+        except (IOError, ValueError):
+            return {}
+
+    def run(self, period):
+        """
+        Refreshes file every period seconds until stopped.
+        """
+        while not self.stopping.is_set():
+            try:
+                self.refresh()
+            except Exception:  # pylint: disable=broad-except
+                log.exception('Refreshing %s failed', self.url)
+            self.stopping.wait(period)
+
+    def start(self, period):
+        """
+        Runs refreshing in a background thread.
+        """
+        self.thread = Thread(
+            target=self.run, args=(period,), name='refresh-users-xml'
+        )
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops background thread.
+        """
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
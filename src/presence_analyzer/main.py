@@ -5,5 +5,8 @@ Flask app initialization.
 from flask import Flask
 from flask.ext.mako import MakoTemplates
 
+from presence_analyzer.profiling import ProfilerMiddleware
+
 app = Flask(__name__)  # pylint: disable=invalid-name
+app.wsgi_app = ProfilerMiddleware(app.wsgi_app, app.config)
 mako = MakoTemplates(app)
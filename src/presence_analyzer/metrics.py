@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Counters and histograms exposed in Prometheus text format.
+"""
+
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock
+
+REGISTRY = []  # All metrics rendered by /metrics view.
+
+# Upper bounds of histogram buckets in seconds.
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0,
+)
+
+
+def format_labels(names, values, extra=()):
+    """
+    Formats label set, eg. '{function="get_data",result="hit"}'.
+    """
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace('\\', r'\\').replace('"', r'\"')
+            .replace('\n', r'\n'),
+        )
+        for name, value in pairs
+    ))
+
+
+def format_value(value):
+    """
+    Formats number of a sample.
+    """
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Counter(object):
+    """
+    Monotonically increasing count of events, one for every label values.
+    """
+
+    def __init__(self, name, documentation, labels=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.lock = Lock()
+        self.values = {}
+        registry.append(self)
+
+    def inc(self, *label_values):
+        """
+        Counts one event.
+        """
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + 1
+
+    def value(self, *label_values):
+        """
+        Returns current count.
+        """
+        return self.values.get(label_values, 0)
+
+    def render(self):
+        """
+        Returns lines of text format.
+        """
+        lines = [
+            '# HELP {} {}'.format(self.name, self.documentation),
+            '# TYPE {} counter'.format(self.name),
+        ]
+        with self.lock:
+            values = sorted(self.values.items())
+        for label_values, value in values:
+            lines.append('{}{} {}'.format(
+                self.name,
+                format_labels(self.labels, label_values),
+                format_value(value),
+            ))
+        return lines
+
+
+class Histogram(object):
+    """
+    Distribution of observed durations in buckets, one for every label values.
+    """
+
+    def __init__(
+            self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS,
+            registry=REGISTRY,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self.lock = Lock()
+        # label values: [count of every bucket and +Inf, sum]
+        self.values = {}
+        registry.append(self)
+
+    def observe(self, value, *label_values):
+        """
+        Records single observation.
+        """
+        bucket = bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(label_values)
+            if state is None:
+                state = self.values[label_values] = [
+                    [0] * (len(self.buckets) + 1), 0.0
+                ]
+            state[0][bucket] += 1
+            state[1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        """
+        Observes duration of the block.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, *label_values)
+
+    def timed(self, *label_values):
+        """
+        Decorator observing duration of every call.
+        """
+        def wrapper(function):
+            @wraps(function)
+            def inner(*args, **kwargs):
+                start = time.time()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.observe(time.time() - start, *label_values)
+            return inner
+        return wrapper
+
+    def count(self, *label_values):
+        """
+        Returns number of observations.
+        """
+        state = self.values.get(label_values)
+        return sum(state[0]) if state is not None else 0
+
+    def render(self):
+        """
+        Returns lines of text format.
+        """
+        lines = [
+            '# HELP {} {}'.format(self.name, self.documentation),
+            '# TYPE {} histogram'.format(self.name),
+        ]
+        with self.lock:
+            values = sorted(
+                (label_values, (list(counts), total))
+                for label_values, (counts, total) in self.values.items()
+            )
+        bounds = [format_value(bound) for bound in self.buckets] + ['+Inf']
+        for label_values, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name,
+                    format_labels(self.labels, label_values, [('le', bound)]),
+                    cumulative,
+                ))
+            labels = format_labels(self.labels, label_values)
+            lines.append('{}_sum{} {}'.format(
+                self.name, labels, format_value(total)
+            ))
+            lines.append('{}_count{} {}'.format(self.name, labels, cumulative))
+        return lines
+
+
+def render(registry=REGISTRY):
+    """
+    Returns all metrics of registry in Prometheus text format.
+    """
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
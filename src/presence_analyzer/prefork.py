@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+Pre-forking multi-process WSGI server.
+"""
+
+import errno
+import logging
+import os
+import signal
+import socket
+import time
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+class QuietWSGIRequestHandler(WSGIRequestHandler):
+    """
+    Request handler logging through logging module instead of stderr.
+    """
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        log.info('%s - %s', self.client_address[0], format % args)
+
+
+class WorkerWSGIServer(WSGIServer):
+    """
+    WSGI server counting processed requests.
+    """
+    served = 0
+
+    def process_request(self, request, client_address):
+        self.served += 1
+        WSGIServer.process_request(self, request, client_address)
+
+
+class PreforkServer(object):
+    """
+    Serves WSGI application from a pool of forked worker processes.
+
+    Master process binds the socket and calls preload (eg. loads datasets)
+    before forking, so workers share its memory pages copy-on-write.
+    Every worker calls post_fork before serving, eg. to start background
+    threads, which master mustn't run as it forks.
+    Workers which die or serve max_requests are replaced.
+
+    Signals handled by master:
+     - SIGTERM, SIGINT: stop workers after their current request and exit,
+     - SIGHUP: call preload again and replace workers one by one.
+    """
+
+    def __init__(
+            self, app, host, port, workers=4, max_requests=0,
+            preload=None, backlog=128, post_fork=None,
+    ):
+        self.app = app
+        self.address = (host, port)
+        self.workers = workers
+        self.max_requests = max_requests
+        self.preload = preload
+        self.post_fork = post_fork
+        self.backlog = backlog
+        self.socket = None
+        self.children = set()
+        self.stopping = False
+        self.restarting = False
+
+    def bind(self):
+        """
+        Creates listening socket shared by all workers.
+        """
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(self.address)
+        self.socket.listen(self.backlog)
+        # Workers compete for connections, losers mustn't block in accept.
+        self.socket.setblocking(False)
+        self.address = self.socket.getsockname()
+
+    def serve_forever(self):
+        """
+        Runs master process until it is stopped.
+        """
+        if self.socket is None:
+            self.bind()
+        if self.preload is not None:
+            self.preload()
+
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGHUP, self._restart)
+        log.info(
+            'Serving on %s:%d with %d workers', self.address[0],
+            self.address[1], self.workers,
+        )
+        try:
+            while not self.stopping:
+                if self.restarting:
+                    self.restarting = False
+                    self.rolling_restart()
+                while len(self.children) < self.workers:
+                    self.spawn()
+                self.reap(block=True)
+        finally:
+            self.stop_workers()
+            self.socket.close()
+
+    def spawn(self):
+        """
+        Forks new worker process.
+        """
+        pid = os.fork()
+        if pid:
+            self.children.add(pid)
+            return pid
+
+        # pylint: disable=protected-access, broad-except
+        try:
+            if self.post_fork is not None:
+                self.post_fork()
+            Worker(self.app, self.socket, self.max_requests).run()
+        except Exception:
+            log.exception('Worker %d failed', os.getpid())
+            os._exit(1)
+        os._exit(0)
+
+    def reap(self, block=False):
+        """
+        Collects exited workers. Returns pids of them.
+        """
+        exited = []
+        while self.children:
+            try:
+                pid, _ = os.waitpid(-1, 0 if block else os.WNOHANG)
+            except OSError as error:
+                if error.errno == errno.EINTR:
+                    break
+                if error.errno == errno.ECHILD:
+                    self.children.clear()
+                    break
+                raise
+            if not pid:
+                break
+            self.children.discard(pid)
+            exited.append(pid)
+            block = False
+        return exited
+
+    def rolling_restart(self):
+        """
+        Reloads data and replaces workers one at a time.
+        """
+        log.info('Restarting workers')
+        if self.preload is not None:
+            self.preload()
+        for pid in list(self.children):
+            if self.stopping:
+                return
+            self.spawn()
+            self._terminate(pid)
+            while pid in self.children and not self.stopping:
+                self.reap(block=True)
+
+    def stop_workers(self, timeout=30):
+        """
+        Asks workers to finish and waits for them.
+        """
+        for pid in self.children:
+            self._terminate(pid)
+        deadline = time.time() + timeout
+        while self.children and time.time() < deadline:
+            if not self.reap():
+                time.sleep(0.1)
+        for pid in self.children:
+            self._terminate(pid, signal.SIGKILL)
+        self.reap()
+
+    def _terminate(self, pid, signum=signal.SIGTERM):
+        """
+        Sends signal to worker, which may be already gone.
+        """
+        try:
+            os.kill(pid, signum)
+        except OSError as error:
+            if error.errno != errno.ESRCH:
+                raise
+
+    def _stop(self, signum, frame):  # pylint: disable=unused-argument
+        """
+        Signal handler stopping the server.
+        """
+        self.stopping = True
+
+    def _restart(self, signum, frame):  # pylint: disable=unused-argument
+        """
+        Signal handler scheduling rolling restart.
+        """
+        self.restarting = True
+
+
+class Worker(object):
+    """
+    Single worker process accepting connections from inherited socket.
+    """
+
+    def __init__(self, app, listener, max_requests=0, poll_interval=1):
+        self.stopping = False
+        self.max_requests = max_requests
+        self.server = WorkerWSGIServer(
+            listener.getsockname(),
+            QuietWSGIRequestHandler,
+            bind_and_activate=False,
+        )
+        self.server.socket.close()
+        self.server.socket = listener
+        self.server.server_name = socket.getfqdn(listener.getsockname()[0])
+        self.server.server_port = listener.getsockname()[1]
+        self.server.setup_environ()
+        self.server.set_app(app)
+        self.server.timeout = poll_interval
+
+    def run(self):
+        """
+        Handles requests until asked to stop or max_requests is reached.
+        """
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        while not self.stopping:
+            self.server.handle_request()
+            if self.max_requests and self.server.served >= self.max_requests:
+                break
+
+    def _stop(self, signum, frame):  # pylint: disable=unused-argument
+        """
+        Signal handler finishing worker after current request.
+        """
+        self.stopping = True
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Profiling of single requests on demand.
+"""
+
+import cProfile
+import logging
+import os
+import pstats
+import re
+import time
+from cStringIO import StringIO
+from hmac import compare_digest
+from urlparse import parse_qs
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+PROFILE_HEADER = 'HTTP_X_PROFILE_TOKEN'
+PROFILE_ARGUMENT = 'profile'
+REPORT_LINES = 60
+
+
+class ProfilerMiddleware(object):
+    """
+    Runs requests carrying profiling token under cProfile.
+
+    Profiling is enabled by PROFILE_TOKEN config option. The token is sent
+    in X-Profile-Token header or 'profile' query parameter. Profile of the
+    request, including streaming of the response, is saved in pstats
+    format to PROFILE_DIR, which name is returned in X-Profile header.
+    Without PROFILE_DIR the response is replaced by text report of
+    functions sorted by cumulative time.
+
+    Requests without token only pay for a config lookup.
+    """
+
+    def __init__(self, wsgi_app, config):
+        self.wsgi_app = wsgi_app
+        self.config = config
+
+    def __call__(self, environ, start_response):
+        token = self.config.get('PROFILE_TOKEN')
+        if not token or not self._is_requested(environ, token):
+            return self.wsgi_app(environ, start_response)
+
+        captured = {}
+
+        def capture(status, headers, exc_info=None):
+            """
+            Delays start of response until profile is ready.
+            """
+            captured['status'] = status
+            captured['headers'] = headers
+            captured['exc_info'] = exc_info
+            return captured.setdefault('body', []).append
+
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            app_iter = self.wsgi_app(environ, capture)
+            try:
+                body = captured.get('body', []) + list(app_iter)
+            finally:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+        finally:
+            profile.disable()
+
+        directory = self.config.get('PROFILE_DIR')
+        if not directory:
+            report = self.report(profile)
+            start_response(b'200 OK', [
+                (b'Content-Type', b'text/plain; charset=utf-8'),
+                (b'Content-Length', str(len(report))),
+            ])
+            return [report]
+
+        path = self.save(profile, directory, environ)
+        log.info('Profile of %s saved to %s', environ.get('PATH_INFO'), path)
+        headers = [
+            (name, value) for name, value in captured['headers']
+            if name.lower() != 'x-profile'
+        ]
+        headers.append((b'X-Profile', os.path.basename(path)))
+        start_response(captured['status'], headers, captured['exc_info'])
+        return body
+
+    def _is_requested(self, environ, token):
+        """
+        Checks if request carries valid profiling token.
+        """
+        given = environ.get(PROFILE_HEADER)
+        if given is None:
+            values = parse_qs(environ.get('QUERY_STRING', ''))
+            given = values.get(PROFILE_ARGUMENT, [''])[0]
+        if isinstance(token, unicode):
+            token = token.encode('utf-8')
+        return bool(given) and compare_digest(given, token)
+
+    @staticmethod
+    def report(profile):
+        """
+        Returns text report of profile sorted by cumulative time.
+        """
+        stream = StringIO()
+        stats = pstats.Stats(profile, stream=stream)
+        stats.sort_stats('cumulative').print_stats(REPORT_LINES)
+        return stream.getvalue()
+
+    @staticmethod
+    def save(profile, directory, environ):
+        """
+        Saves profile in pstats format. Returns path of the file.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        slug = re.sub(
+            r'[^A-Za-z0-9]+', '-', environ.get('PATH_INFO', '')
+        ).strip('-')
+        path = os.path.join(directory, '{:.6f}-{}-{}.prof'.format(
+            time.time(), environ.get('REQUEST_METHOD', 'GET'), slug or 'root'
+        ))
+        profile.dump_stats(path)
+        return path
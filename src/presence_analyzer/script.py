@@ -3,10 +3,10 @@
 # pylint:skip-file
 
 import os
+import signal
 import sys
 from functools import partial
 
-from lxml import etree
 import paste.script.command
 import werkzeug.script
 
@@ -25,12 +25,31 @@ for i in range(2 + __name__.count('.')):
 abspath = partial(os.path.join, _buildout_path)
 del _buildout_path
 
+PREFORK_PID = abspath('var', 'log', '.prefork.pid')
 
-# bin/paster serve parts/etc/deploy.ini
-def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
-    from presence_analyzer import app
+
+def load_app(config=DEPLOY_CFG, debug=False, warm_up=True):
+    """Configure the application without starting background threads.
+
+    Commands which don't serve requests pass warm_up=False, so that data
+    caches aren't filled even if WARM_UP_CACHE is set.
+    """
+    from presence_analyzer import app, utils, views
     app.config.from_pyfile(abspath(config))
     app.debug = debug
+    views.ASSETS.build()
+    views.compile_templates()
+    if warm_up and app.config.get('WARM_UP_CACHE'):
+        utils.warm_up(workers=app.config.get('CSV_WORKERS', 1))
+    return app
+
+
+# bin/paster serve parts/etc/deploy.ini
+def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
+    from presence_analyzer import utils
+    app = load_app(config, debug)
+    if app.config.get('XML_REFRESH_INTERVAL'):
+        utils.start_xml_refresh()
     return app
 
 
@@ -45,7 +64,7 @@ def make_debug(global_conf={}, **conf):
 def make_shell():
     """Interactive Flask Shell"""
     from flask import request
-    app = make_app()
+    app = load_app()
     http = app.test_client()
     reqctx = app.test_request_context
     return locals()
@@ -79,6 +98,48 @@ def _serve(action, debug=False, dry_run=False):
     paste.script.command.run()
 
 
+def _prefork(workers, host, port, max_requests, debug=False):
+    """Run the application under pre-forking server."""
+    import logging
+    from presence_analyzer import utils
+    from presence_analyzer.prefork import PreforkServer
+    app = load_app(
+        config=DEBUG_CFG if debug else DEPLOY_CFG, debug=debug,
+        warm_up=False,
+    )
+    started = []
+
+    def preload():
+        """Load data on start, read it again on every restart."""
+        utils.warm_up(
+            reload=bool(started),
+            workers=app.config.get('CSV_WORKERS', 1),
+        )
+        started.append(True)
+
+    # Threads don't survive fork, so every worker starts its own refresher.
+    post_fork = None
+    if app.config.get('XML_REFRESH_INTERVAL'):
+        post_fork = utils.start_xml_refresh
+    server = PreforkServer(
+        app, host, port,
+        workers=workers,
+        max_requests=max_requests,
+        preload=preload,
+        post_fork=post_fork,
+    )
+    logging.basicConfig(
+        level=logging.DEBUG if debug else logging.INFO,
+        format='%(asctime)s %(levelname)s [%(name)s] %(message)s',
+    )
+    with open(PREFORK_PID, 'w') as pidfile:
+        pidfile.write(str(os.getpid()))
+    try:
+        server.serve_forever()
+    finally:
+        os.unlink(PREFORK_PID)
+
+
 # bin/flask-ctl ...
 def run():
     action_shell = werkzeug.script.make_shell(make_shell, make_shell.__doc__)
@@ -111,16 +172,76 @@ def run():
         """Stop the application."""
         _serve('stop', dry_run=dry_run)
 
+    # bin/flask-ctl prefork [-w 4] [-p 8082]
+    def action_prefork(workers=('w', 4), host=('h', '0.0.0.0'),
+                       port=('p', 8082), max_requests=200, debug=False):
+        """Serve the application from a pool of forked processes.
+
+        Datasets are loaded before forking, so workers share them.
+        Send SIGHUP to the master process (see var/log/.prefork.pid)
+        to reload data and restart workers one by one, SIGTERM to stop.
+        """
+        _prefork(workers, host, port, max_requests, debug)
+
+    # bin/flask-ctl prefork_restart
+    def action_prefork_restart():
+        """Reload data and restart prefork workers one by one."""
+        with open(PREFORK_PID) as pidfile:
+            os.kill(int(pidfile.read()), signal.SIGHUP)
+
     werkzeug.script.run()
 
 
 def update_xml():
     """
     Updates users.xml file
+
+    bin/update-xml [interval] - with interval in seconds it keeps
+    refreshing the file until it is stopped.
+    """
+    import logging
+    from presence_analyzer import loaders
+    app = load_app(warm_up=False)
+    refresher = loaders.UsersXMLRefresher(
+        app.config['XML_URL'],
+        app.config['DATA_XML'],
+        timeout=app.config.get('XML_TIMEOUT', 10),
+    )
+    if len(sys.argv) > 1:
+        logging.basicConfig(
+            level=logging.INFO,
+            format='%(asctime)s %(levelname)s [%(name)s] %(message)s',
+        )
+        refresher.run(float(sys.argv[1]))
+    elif refresher.refresh():
+        print('XML FILE UPDATED')
+    else:
+        print('XML FILE UP TO DATE')
+
+
+def build_snapshot():
+    """
+    Writes binary snapshot of presence data to DATA_SNAPSHOT file.
+    """
+    from presence_analyzer import loaders
+    app = load_app(warm_up=False)
+    rows = loaders.build_snapshot(
+        app.config['DATA_CSV'],
+        app.config['DATA_SNAPSHOT'],
+        workers=app.config.get('CSV_WORKERS', 1),
+    )
+    print('SNAPSHOT OF {} ROWS WRITTEN TO {}'.format(
+        rows, app.config['DATA_SNAPSHOT']
+    ))
+
+
+def import_sqlite():
+    """
+    Imports DATA_CSV file into DATA_SQLITE database.
     """
-    app = make_app()
-    newdata = etree.parse(app.config['XML_URL'])
-    oldfile = app.config['DATA_XML']
-    with open(oldfile, 'w') as xmlfile:
-        newdata.write(xmlfile, encoding='UTF-8')
-    print('XML FILE UP TO DATE')
+    from presence_analyzer import loaders
+    app = load_app(warm_up=False)
+    rows = loaders.import_sqlite(
+        app.config['DATA_CSV'], app.config['DATA_SQLITE']
+    )
+    print('{} ROWS IMPORTED TO {}'.format(rows, app.config['DATA_SQLITE']))
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Binary snapshot of parsed presence data.
+
+Snapshot file starts with a header, then user-offset index follows as
+(user_id, begin, end) int32 triples, then dates, starts and ends int32
+columns and finally int8 weekdays column. All numbers are in byte order
+of the machine that wrote the file, so columns can be read or mapped into
+memory as they are.
+
+Mapped snapshot is shared by all processes of the host through page cache,
+new version is published by renaming new file over the old one.
+"""
+
+import ctypes
+import mmap
+import os
+import stat
+import struct
+import sys
+import tempfile
+import zlib
+from array import array
+from contextlib import contextmanager
+
+from presence_analyzer.store import PresenceStore, as_array
+
+MAGIC = 'PRESNAP1'
+
+# magic, byte order, source size, source mtime, offset of the last complete
+# line of source, source checksum, number of rows, number of users
+HEADER = struct.Struct('<8s8sqdqIII4x')
+
+CHECKSUM_CHUNK = 1 << 20
+NEW_FILE_MODE = 0o644
+
+
+def copy_mode(tmp_path, path):
+    """
+    Gives temporary file the mode of the file it replaces.
+
+    mkstemp creates files readable only by the owner, new files get
+    NEW_FILE_MODE instead.
+    """
+    try:
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except OSError:
+        mode = NEW_FILE_MODE
+    os.chmod(tmp_path, mode)
+
+
+@contextmanager
+def replace_file(path):
+    """
+    Opens temporary file, which replaces given one when block succeeds.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as tmpfile:
+            yield tmpfile
+        copy_mode(tmp_path, path)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def file_checksum(sourcefile, size):
+    """
+    Calculates CRC-32 of first size bytes of given file.
+    """
+    sourcefile.seek(0)
+    checksum = 0
+    while size > 0:
+        chunk = sourcefile.read(min(size, CHECKSUM_CHUNK))
+        if not chunk:
+            break
+        checksum = zlib.crc32(chunk, checksum)
+        size -= len(chunk)
+    return checksum & 0xffffffff
+
+
+def write_snapshot(path, store, source):
+    """
+    Writes store to snapshot file.
+
+    Source is dict with 'size', 'mtime', 'offset' and 'checksum' of the
+    CSV file the store was loaded from. File is replaced atomically.
+    """
+    index = array('i')
+    for user_id, (begin, end) in sorted(store.offsets.iteritems()):
+        index.extend((user_id, begin, end))
+
+    with replace_file(path) as snapshotfile:
+        snapshotfile.write(HEADER.pack(
+            MAGIC,
+            sys.byteorder,
+            source['size'],
+            source['mtime'],
+            source['offset'],
+            source['checksum'],
+            len(store.dates),
+            len(store.offsets),
+        ))
+        index.tofile(snapshotfile)
+        as_array('i', store.dates).tofile(snapshotfile)
+        as_array('i', store.starts).tofile(snapshotfile)
+        as_array('i', store.ends).tofile(snapshotfile)
+        as_array('b', store.weekdays).tofile(snapshotfile)
+
+
+def read_header(snapshotfile):
+    """
+    Reads and validates snapshot header.
+
+    Returns dict with source description and sizes of the columns.
+    """
+    raw = snapshotfile.read(HEADER.size)
+    if len(raw) != HEADER.size:
+        raise ValueError('Snapshot header is truncated')
+    (
+        magic, byteorder, size, mtime, offset, checksum, rows, users
+    ) = HEADER.unpack(raw)
+    if magic != MAGIC:
+        raise ValueError('Not a presence snapshot')
+    if byteorder.rstrip('\0') != sys.byteorder:
+        raise ValueError('Snapshot written with different byte order')
+    return {
+        'size': size,
+        'mtime': mtime,
+        'offset': offset,
+        'checksum': checksum,
+        'rows': rows,
+        'users': users,
+    }
+
+
+def read_snapshot(path):
+    """
+    Reads snapshot file. Returns its header and PresenceStore.
+    """
+    with open(path, 'rb') as snapshotfile:
+        header = read_header(snapshotfile)
+        try:
+            index = array('i')
+            index.fromfile(snapshotfile, header['users'] * 3)
+            columns = []
+            for typecode in 'iiib':
+                column = array(typecode)
+                column.fromfile(snapshotfile, header['rows'])
+                columns.append(column)
+        except EOFError:
+            raise ValueError('Snapshot is truncated')
+
+    offsets = dict(
+        (index[i], (index[i + 1], index[i + 2]))
+        for i in xrange(0, len(index), 3)
+    )
+    return header, PresenceStore(*(columns + [offsets]))
+
+
+def map_snapshot(path):
+    """
+    Maps snapshot file into memory. Returns its header and PresenceStore.
+
+    Columns of the store are ctypes arrays backed by a private mapping of
+    the file, which is never written to, so its pages stay shared with
+    other processes mapping the same file. Mapping lives as long as
+    the store.
+    """
+    with open(path, 'rb') as snapshotfile:
+        header = read_header(snapshotfile)
+        size = os.fstat(snapshotfile.fileno()).st_size
+        users, rows = header['users'], header['rows']
+        if size < HEADER.size + 4 * 3 * users + 13 * rows:
+            raise ValueError('Snapshot is truncated')
+        region = mmap.mmap(
+            snapshotfile.fileno(), 0, access=mmap.ACCESS_COPY
+        )
+
+    position = HEADER.size
+    index = (ctypes.c_int32 * (users * 3)).from_buffer(region, position)
+    position += ctypes.sizeof(index)
+    columns = []
+    for ctype in (ctypes.c_int32, ctypes.c_int32, ctypes.c_int32):
+        column = (ctype * rows).from_buffer(region, position)
+        position += ctypes.sizeof(column)
+        columns.append(column)
+    columns.append((ctypes.c_int8 * rows).from_buffer(region, position))
+
+    offsets = dict(
+        (index[i], (index[i + 1], index[i + 2]))
+        for i in xrange(0, len(index), 3)
+    )
+    return header, PresenceStore(*(columns + [offsets]))
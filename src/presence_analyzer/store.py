@@ -0,0 +1,441 @@
+# -*- coding: utf-8 -*-
+"""
+Compact columnar storage for presence data.
+"""
+
+import datetime
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import compress, imap, repeat
+from operator import eq, itemgetter
+
+
+def time_from_seconds(seconds):
+    """
+    Creates datetime.time object from amount of seconds since midnight.
+    """
+    return datetime.time(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def as_array(typecode, column):
+    """
+    Returns column as array, copies it only when it is other sequence.
+    """
+    if isinstance(column, array) and column.typecode == typecode:
+        return column
+    return array(typecode, column)
+
+
+def month_key(year, month):
+    """
+    Creates key of given month used by group_by_months, eg. '2013.09'.
+    """
+    return '{}.{:02d}'.format(year, month)
+
+
+def weekday_mask(weekdays, weekday):
+    """
+    Selects entries of given weekday from weekdays column.
+    """
+    return imap(eq, weekdays, repeat(weekday))
+
+
+def aggregate_weekdays(starts, ends, weekdays):
+    """
+    Sums up presence columns by weekday.
+
+    Returns dict with 'weekday_count', 'weekday_total', 'start_total' and
+    'end_total' lists, see UserPresence.aggregate().
+    """
+    result = {
+        'weekday_count': [],
+        'weekday_total': [],
+        'start_total': [],
+        'end_total': [],
+    }
+    for weekday in xrange(7):
+        start_total = sum(compress(starts, weekday_mask(weekdays, weekday)))
+        end_total = sum(compress(ends, weekday_mask(weekdays, weekday)))
+        result['weekday_count'].append(
+            sum(weekday_mask(weekdays, weekday))
+        )
+        result['weekday_total'].append(end_total - start_total)
+        result['start_total'].append(start_total)
+        result['end_total'].append(end_total)
+    return result
+
+
+def histogram(values, width, count):
+    """
+    Counts values falling into count buckets of given width from zero.
+
+    Values are counted in a single pass without copying them. Values out
+    of the buckets range are not counted.
+    """
+    result = [0] * count
+    limit = width * count
+    for value in values:
+        if 0 <= value < limit:
+            result[value // width] += 1
+    return result
+
+
+def sum_by_months(dates, starts, ends):
+    """
+    Sums presence intervals of date-sorted columns month by month.
+
+    Month boundaries are found by binary search, so every month costs two
+    sums over a slice of the columns.
+    """
+    result = {}
+    if not dates:
+        return result
+
+    current = datetime.date.fromordinal(dates[0])
+    year, month = current.year, current.month
+    begin = 0
+    while begin < len(dates):
+        next_year, next_month = year + month // 12, month % 12 + 1
+        end = bisect_left(
+            dates, datetime.date(next_year, next_month, 1).toordinal(), begin
+        )
+        if end > begin:
+            result[month_key(year, month)] = (
+                sum(ends[begin:end]) - sum(starts[begin:end])
+            )
+        begin = end
+        year, month = next_year, next_month
+
+    return result
+
+
+def merge_rows(columns, old, old_begin, old_end, new, new_begin, new_end):
+    """
+    Appends date-sorted rows of two column slices in order of dates.
+
+    Rows of new columns override old ones with the same date. Dates are
+    the first of columns.
+    """
+    i, j = old_begin, new_begin
+    while i < old_end or j < new_end:
+        if j == new_end or (i < old_end and old[0][i] < new[0][j]):
+            source, position = old, i
+            i += 1
+        else:
+            if i < old_end and old[0][i] == new[0][j]:
+                i += 1
+            source, position = new, j
+            j += 1
+        for column, source_column in zip(columns, source):
+            column.append(source_column[position])
+
+
+class PresenceStore(object):
+    """
+    Presence data kept in contiguous int32 columns.
+
+    Rows are sorted by user_id and date. For every row there is a date
+    ordinal, start and end of presence as seconds since midnight and
+    a weekday number. Rows of a single user occupy one slice of the columns,
+    which boundaries are kept in the user-offset index:
+    offsets = {
+        user_id: (begin, end),
+    }
+    Columns are arrays or other int sequences, eg. ctypes arrays over
+    a memory-mapped snapshot.
+    """
+
+    def __init__(self, dates, starts, ends, weekdays, offsets):
+        self.dates = dates
+        self.starts = starts
+        self.ends = ends
+        self.weekdays = weekdays
+        self.offsets = offsets
+        self._aggregates = None
+        self._totals = None
+
+    @classmethod
+    def from_columns(cls, users, dates, starts, ends):
+        """
+        Builds store from unsorted columns, eg. in order of CSV file rows.
+
+        When user has more than one entry for the same date the last one
+        is used.
+        """
+        order = sorted(
+            xrange(len(users)),
+            key=lambda i: (users[i], dates[i]),
+        )
+        store = cls(array('i'), array('i'), array('i'), array('b'), {})
+        previous = None
+        for position, i in enumerate(order):
+            key = (users[i], dates[i])
+            if position + 1 < len(order):
+                j = order[position + 1]
+                if (users[j], dates[j]) == key:
+                    # Entry overridden by the next row.
+                    continue
+            user_id = users[i]
+            if user_id != previous:
+                store.offsets[user_id] = (len(store.dates), len(store.dates))
+                previous = user_id
+            store.dates.append(dates[i])
+            store.starts.append(starts[i])
+            store.ends.append(ends[i])
+            store.weekdays.append((dates[i] - 1) % 7)
+            begin, _ = store.offsets[user_id]
+            store.offsets[user_id] = (begin, len(store.dates))
+        return store
+
+    def columns(self):
+        """
+        Returns users, dates, starts and ends columns of the store.
+        """
+        users = array('i')
+        for user_id, (begin, end) in sorted(
+                self.offsets.iteritems(), key=itemgetter(1)):
+            users.extend(array('i', [user_id]) * (end - begin))
+        return (
+            users,
+            as_array('i', self.dates),
+            as_array('i', self.starts),
+            as_array('i', self.ends),
+        )
+
+    def merge(self, users, dates, starts, ends):
+        """
+        Creates new store with given rows added to the existing ones.
+
+        Given rows override existing entries for the same user and date.
+        Only the new rows are sorted, existing ones are copied user by user
+        as slices. Entries of a user are merged row by row only when new
+        dates fall between the existing ones.
+        """
+        if not users:
+            return self
+        added = self.from_columns(users, dates, starts, ends)
+        old = (
+            as_array('i', self.dates),
+            as_array('i', self.starts),
+            as_array('i', self.ends),
+            as_array('b', self.weekdays),
+        )
+        new = (added.dates, added.starts, added.ends, added.weekdays)
+        merged = self.__class__(
+            array('i'), array('i'), array('i'), array('b'), {}
+        )
+        columns = (merged.dates, merged.starts, merged.ends, merged.weekdays)
+        for user_id in sorted(set(self.offsets) | set(added.offsets)):
+            old_begin, old_end = self.offsets.get(user_id, (0, 0))
+            new_begin, new_end = added.offsets.get(user_id, (0, 0))
+            begin = len(merged.dates)
+            if (
+                    old_begin == old_end or new_begin == new_end or
+                    old[0][old_end - 1] < new[0][new_begin]
+            ):
+                for column, old_column, new_column in zip(columns, old, new):
+                    column.extend(old_column[old_begin:old_end])
+                    column.extend(new_column[new_begin:new_end])
+            else:
+                merge_rows(
+                    columns, old, old_begin, old_end, new, new_begin, new_end
+                )
+            merged.offsets[user_id] = (begin, len(merged.dates))
+        return merged
+
+    @property
+    def aggregates(self):
+        """
+        Index of UserPresence.aggregate() results by user_id.
+
+        It is computed on first access and kept for the lifetime of the
+        store, which is replaced as a whole when data changes.
+        """
+        if self._aggregates is None:
+            self._aggregates = dict(
+                (user_id, self[user_id].aggregate())
+                for user_id in self.offsets
+            )
+        return self._aggregates
+
+    @property
+    def totals(self):
+        """
+        Presence of all users summed up together like in aggregates.
+
+        Weekday sums come from a single pass over whole columns, monthly
+        ones from the per-user index. Computed on first access.
+        """
+        if self._totals is None:
+            totals = aggregate_weekdays(self.starts, self.ends, self.weekdays)
+            totals['months'] = {}
+            for aggregates in self.aggregates.itervalues():
+                for month, total in aggregates['months'].iteritems():
+                    totals['months'][month] = (
+                        totals['months'].get(month, 0) + total
+                    )
+            self._totals = totals
+        return self._totals
+
+    def user_aggregates(self, user_id, first=None, last=None):
+        """
+        Returns aggregates of user's presence from first to last date ordinal.
+
+        Whole period comes from the precomputed index, other ones are summed
+        up from the slice of user's entries.
+        """
+        if first is None and last is None:
+            return self.aggregates[user_id]
+        return self[user_id].between(first, last).aggregate()
+
+    def start_histogram(self, width, count):
+        """
+        Counts entries started in each of count periods of width seconds.
+        """
+        return histogram(self.starts, width, count)
+
+    def __contains__(self, user_id):
+        return user_id in self.offsets
+
+    def __getitem__(self, user_id):
+        begin, end = self.offsets[user_id]
+        return UserPresence(self, begin, end)
+
+    def __iter__(self):
+        return iter(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def keys(self):
+        """
+        Returns list of user ids.
+        """
+        return self.offsets.keys()
+
+
+class UserPresence(object):
+    """
+    Read-only view of single user's slice of PresenceStore.
+
+    It behaves like mapping of datetime.date objects to
+    {'start': datetime.time, 'end': datetime.time} dicts, but aggregations
+    should use the columns directly.
+    """
+
+    def __init__(self, store, begin, end):
+        self.store = store
+        self.begin = begin
+        self.end = end
+
+    @property
+    def dates(self):
+        """
+        Date ordinals of user's entries.
+        """
+        return self.store.dates[self.begin:self.end]
+
+    @property
+    def starts(self):
+        """
+        Starts of presence in seconds since midnight.
+        """
+        return self.store.starts[self.begin:self.end]
+
+    @property
+    def ends(self):
+        """
+        Ends of presence in seconds since midnight.
+        """
+        return self.store.ends[self.begin:self.end]
+
+    @property
+    def weekdays(self):
+        """
+        Weekday numbers of user's entries.
+        """
+        return self.store.weekdays[self.begin:self.end]
+
+    def between(self, first=None, last=None):
+        """
+        Returns view of entries from first to last date ordinal inclusive.
+
+        Range is found by binary search, either end may be None.
+        """
+        dates = self.store.dates
+        begin, end = self.begin, self.end
+        if first is not None:
+            begin = bisect_left(dates, first, begin, end)
+        if last is not None:
+            end = bisect_right(dates, last, begin, end)
+        return UserPresence(self.store, begin, max(begin, end))
+
+    def entries(self):
+        """
+        Yields (date ordinal, start, end) of user's entries one by one.
+        """
+        store = self.store
+        for i in xrange(self.begin, self.end):
+            yield store.dates[i], store.starts[i], store.ends[i]
+
+    def aggregate(self):
+        """
+        Sums up user's presence.
+
+        It creates structure like this:
+        result = {
+            'weekday_count': [1, 2, 0, 0, 0, 0, 0],
+            'weekday_total': [28800, 57600, 0, 0, 0, 0, 0],
+            'start_total': [32400, 61200, 0, 0, 0, 0, 0],
+            'end_total': [61200, 118800, 0, 0, 0, 0, 0],
+            'months': {
+                '2013.09': 86400,
+            },
+        }
+        """
+        result = aggregate_weekdays(self.starts, self.ends, self.weekdays)
+        result['months'] = sum_by_months(self.dates, self.starts, self.ends)
+        return result
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, UserPresence) and
+            self.store is other.store and
+            (self.begin, self.end) == (other.begin, other.end)
+        )
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self.store), self.begin, self.end))
+
+    def _position(self, date):
+        """
+        Returns column index of given date or None if there is no entry.
+        """
+        ordinal = date.toordinal()
+        i = bisect_left(self.store.dates, ordinal, self.begin, self.end)
+        if i < self.end and self.store.dates[i] == ordinal:
+            return i
+        return None
+
+    def __contains__(self, date):
+        return self._position(date) is not None
+
+    def __getitem__(self, date):
+        i = self._position(date)
+        if i is None:
+            raise KeyError(date)
+        return {
+            'start': time_from_seconds(self.store.starts[i]),
+            'end': time_from_seconds(self.store.ends[i]),
+        }
+
+    def __iter__(self):
+        return (
+            datetime.date.fromordinal(ordinal) for ordinal in self.dates
+        )
+
+    def __len__(self):
+        return self.end - self.begin
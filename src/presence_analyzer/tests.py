@@ -4,18 +4,47 @@ Presence analyzer unit tests.
 """
 from __future__ import unicode_literals
 
+import BaseHTTPServer
+import os
 import os.path
 import json
+import pstats
 import datetime
+import multiprocessing
+import shutil
+import tempfile
+import signal
+import threading
+import time
+import urllib2
 import unittest
+import zlib
+from collections import OrderedDict
 
-from presence_analyzer import main, views, utils
+from presence_analyzer import (
+    assets,
+    benchmark,
+    collation,
+    database,
+    loaders,
+    main,
+    metrics,
+    prefork,
+    snapshot,
+    store,
+    utils,
+    views,
+)
 
 
 TEST_DATA_CSV = os.path.join(
     os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'test_data.csv'
 )
 
+SAMPLE_DATA_CSV = os.path.join(
+    os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'sample_data.csv'
+)
+
 TEST_DATA_XML = os.path.join(
     os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'test_users.xml'
 )
@@ -49,6 +78,50 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertEqual(resp.status_code, 302)
         assert resp.headers['Location'].endswith('/presence_start_end.html')
 
+    def test_pages(self):
+        """
+        Test rendering of pages from compiled templates and page cache.
+        """
+        module_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, module_directory)
+        main.app.config.update({
+            'MAKO_MODULE_DIRECTORY': module_directory,
+            'MAKO_FILESYSTEM_CHECKS': False,
+        })
+        main.app._mako_lookup = None  # pylint: disable=protected-access
+        self.addCleanup(setattr, main.app, '_mako_lookup', None)
+        self.addCleanup(main.app.config.update, {
+            'MAKO_MODULE_DIRECTORY': None,
+            'MAKO_FILESYSTEM_CHECKS': True,
+        })
+        views.render_page.cache_clear()
+        before = views.render_page.cache_info()
+        views.compile_templates()
+        self.assertIn('presence_weekday.html.py', os.listdir(
+            module_directory
+        ))
+        self.assertIn('base.html.py', os.listdir(module_directory))
+        self.assertNotIn('base.html', views.PAGES)
+        self.assertIn('presence_weekday.html', views.PAGES)
+
+        resp = self.client.get('/presence_weekday.html')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('Presence sorted by weekdays', resp.data)
+        self.assertEqual(self.client.get('/presence_weekday.html').data,
+                         resp.data)
+        for page in ('missing.html', 'base.html'):
+            resp = self.client.get('/' + page)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Page not found', resp.data)
+        info = views.render_page.cache_info()
+        self.assertEqual(
+            (
+                info['hits'] - before['hits'],
+                info['misses'] - before['misses'],
+            ),
+            (2, 2),
+        )
+
     def test_api_users(self):
         """
         Test users listing.
@@ -59,9 +132,535 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         data = json.loads(resp.data)
         self.assertEqual(len(data), 4)
         self.assertDictEqual(
-            data[0], {'user_id': '176', 'name': 'Adrian K.'}
+            data[0], {'user_id': '141', 'name': 'Adam P.'}
+        )
+        self.assertDictEqual(
+            data[1], {'user_id': '176', 'name': 'Adrian K.'}
+        )
+
+    def test_api_mean_time_weekday(self):
+        """
+        Test mean presence time grouped by weekday.
+        """
+        resp = self.client.get('/api/v1/mean_time_weekday/10')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        self.assertListEqual(
+            json.loads(resp.data), [
+                ['Mon', 0], ['Tue', 30047.0], ['Wed', 24465.0],
+                ['Thu', 23705.0], ['Fri', 0], ['Sat', 0], ['Sun', 0],
+            ]
+        )
+        resp = self.client.get('/api/v1/mean_time_weekday/9999')
+        self.assertEqual(json.loads(resp.data), 0)
+
+    def test_api_presence_weekday(self):
+        """
+        Test total presence time grouped by weekday.
+        """
+        resp = self.client.get('/api/v1/presence_weekday/10')
+        self.assertEqual(resp.status_code, 200)
+        self.assertListEqual(
+            json.loads(resp.data), [
+                ['Weekday', 'Presence (s)'], ['Mon', 0], ['Tue', 30047],
+                ['Wed', 24465], ['Thu', 23705], ['Fri', 0], ['Sat', 0],
+                ['Sun', 0],
+            ]
+        )
+
+    def test_api_presence_start_end(self):
+        """
+        Test mean start and end of presence grouped by weekday.
+        """
+        resp = self.client.get('/api/v1/presence_start_end/10')
+        self.assertEqual(resp.status_code, 200)
+        self.assertListEqual(
+            json.loads(resp.data), [
+                ['Mon', 0, 0], ['Tue', 34745.0, 64792.0],
+                ['Wed', 33592.0, 58057.0], ['Thu', 38926.0, 62631.0],
+                ['Fri', 0, 0], ['Sat', 0, 0], ['Sun', 0, 0],
+            ]
+        )
+
+    def test_api_monthly_presence(self):
+        """
+        Test presence grouped by months.
+        """
+        resp = self.client.get('/api/v1/monthly_presence/10')
+        self.assertEqual(resp.status_code, 200)
+        self.assertListEqual(
+            json.loads(resp.data),
+            [['Month', 'Presence (s)'], ['2013.09', 78217]],
+        )
+
+    def test_api_date_range(self):
+        """
+        Test limiting statistics to given period.
+        """
+        resp = self.client.get(
+            '/api/v1/presence_weekday/11?from=2013-09-06&to=2013-09-12'
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertListEqual(
+            json.loads(resp.data), [
+                ['Weekday', 'Presence (s)'], ['Mon', 24123],
+                ['Tue', 16564], ['Wed', 25321], ['Thu', 22969], ['Fri', 0],
+                ['Sat', 0], ['Sun', 0],
+            ]
+        )
+        resp = self.client.get('/api/v1/monthly_presence/11?to=2013-01-01')
+        self.assertListEqual(
+            json.loads(resp.data), [['Month', 'Presence (s)']]
+        )
+        resp = self.client.get('/api/v1/mean_time_weekday/10?from=2013-09-11')
+        self.assertListEqual(
+            json.loads(resp.data)[1:4],
+            [['Tue', 0], ['Wed', 24465.0], ['Thu', 23705.0]],
+        )
+        resp = self.client.get(
+            '/api/v1/statistics?users=10&metrics=presence_start_end'
+            '&from=2013-09-12&to=2013-09-12'
+        )
+        self.assertListEqual(
+            json.loads(resp.data)['10']['presence_start_end'][2:4],
+            [['Wed', 0, 0], ['Thu', 38926.0, 62631.0]],
+        )
+
+        resp = self.client.get('/api/v1/presence_weekday/11?from=2013-13-01')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_api_statistics(self):
+        """
+        Test statistics of many users.
+        """
+        resp = self.client.get(
+            '/api/v1/statistics?users=10,9999&metrics=monthly_presence'
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        self.assertDictEqual(
+            json.loads(resp.data), {
+                '10': {
+                    'monthly_presence': [
+                        ['Month', 'Presence (s)'], ['2013.09', 78217],
+                    ],
+                },
+                '9999': {'monthly_presence': 0},
+            }
+        )
+
+        data = json.loads(self.client.get('/api/v1/statistics').data)
+        self.assertItemsEqual(data.keys(), ['10', '11'])
+        self.assertItemsEqual(data['11'].keys(), views.STATISTICS.keys())
+        self.assertListEqual(
+            data['11']['presence_weekday'],
+            json.loads(self.client.get('/api/v1/presence_weekday/11').data),
+        )
+
+        resp = self.client.get('/api/v1/statistics?metrics=unknown')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/v1/statistics?users=abc')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_api_organization(self):
+        """
+        Test statistics of all users summed up together.
+        """
+        resp = self.client.get('/api/v1/organization/presence_weekday')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        self.assertListEqual(
+            json.loads(resp.data), [
+                ['Weekday', 'Presence (s)'], ['Mon', 24123],
+                ['Tue', 46611], ['Wed', 49786], ['Thu', 69673],
+                ['Fri', 6426], ['Sat', 0], ['Sun', 0],
+            ]
+        )
+
+        resp = self.client.get('/api/v1/organization/monthly_presence')
+        self.assertListEqual(
+            json.loads(resp.data),
+            [['Month', 'Presence (s)'], ['2013.09', 78217 + 118402]],
+        )
+
+        resp = self.client.get('/api/v1/organization/unknown')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_api_organization_shared(self):
+        """
+        Test statistics of all users on data mapped from snapshot.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        main.app.config.update({
+            'SHARED_DATA': True,
+            'DATA_SNAPSHOT': os.path.join(tmpdir, 'data.snapshot'),
+        })
+        self.addCleanup(utils.get_data.reload)
+        self.addCleanup(main.app.config.update, {
+            'SHARED_DATA': False, 'DATA_SNAPSHOT': None,
+        })
+        data = utils.get_data.reload()
+        self.assertNotIsInstance(data.weekdays, snapshot.array)
+
+        for metric in ('presence_weekday', 'mean_time_weekday'):
+            resp = self.client.get('/api/v1/organization/' + metric)
+            self.assertEqual(resp.status_code, 200)
+        resp = self.client.get('/api/v1/organization/presence_weekday')
+        self.assertListEqual(
+            json.loads(resp.data)[1:3], [['Mon', 24123], ['Tue', 46611]]
+        )
+
+    def test_api_organization_monthly_users(self):
+        """
+        Test monthly presence of every user.
+        """
+        resp = self.client.get('/api/v1/organization/monthly_presence/users')
+        self.assertEqual(resp.status_code, 200)
+        self.assertDictEqual(
+            json.loads(resp.data), {
+                '10': [['Month', 'Presence (s)'], ['2013.09', 78217]],
+                '11': [['Month', 'Presence (s)'], ['2013.09', 118402]],
+            }
+        )
+
+    def test_api_start_distribution(self):
+        """
+        Test distribution of start hours.
+        """
+        resp = self.client.get('/api/v1/organization/start_distribution')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 25)
+        self.assertListEqual(data[0], ['Hour', 'Entries'])
+        self.assertListEqual(data[10], ['09:00', 6])
+        self.assertListEqual(data[11], ['10:00', 2])
+        self.assertListEqual(data[14], ['13:00', 1])
+        self.assertEqual(sum(count for _, count in data[1:]), 9)
+
+    def test_api_export(self):
+        """
+        Test streaming export of raw entries.
+        """
+        resp = self.client.get('/api/v1/export')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/x-ndjson')
+        rows = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual(len(rows), 9)
+        self.assertDictEqual(
+            rows[0], {
+                'user_id': 10,
+                'date': '2013-09-10',
+                'start': '09:39:05',
+                'end': '17:59:52',
+            }
+        )
+
+        resp = self.client.get(
+            '/api/v1/export?format=csv&users=10,9999'
+            '&from=2013-09-11&to=2013-09-12'
+        )
+        self.assertTrue(resp.content_type.startswith('text/csv'))
+        self.assertEqual(
+            resp.data,
+            '10,2013-09-11,09:19:52,16:07:37\r\n'
+            '10,2013-09-12,10:48:46,17:23:51\r\n',
         )
 
+        with open(TEST_DATA_CSV) as csvfile:
+            source = sorted(csvfile.read().splitlines())
+        resp = self.client.get('/api/v1/export?format=csv')
+        self.assertListEqual(sorted(resp.data.splitlines()), source)
+
+        resp = self.client.get('/api/v1/export?format=xml')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/v1/export?users=abc')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_metrics(self):
+        """
+        Test metrics endpoint.
+        """
+        self.client.get('/api/v1/presence_weekday/10')
+        self.client.get('/api/v1/presence_weekday/10')
+        resp = self.client.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith('text/plain'))
+        self.assertIn('# TYPE presence_request_seconds histogram', resp.data)
+        self.assertIn(
+            'presence_request_seconds_count'
+            '{endpoint="presence_weekday_view",status="200"}',
+            resp.data,
+        )
+        self.assertIn(
+            'presence_cache_lookups_total'
+            '{function="presence_weekday_view",result="hit"}',
+            resp.data,
+        )
+        self.assertIn(
+            'presence_load_seconds_bucket{dataset="presence",', resp.data
+        )
+
+        builds = utils.COMPUTE_SECONDS.count('aggregates')
+        lookups = utils.COMPUTE_SECONDS.count('user_aggregates')
+        data = utils.get_data.reload()
+        self.assertEqual(utils.COMPUTE_SECONDS.count('aggregates'), builds + 1)
+        self.assertIs(
+            utils.user_aggregates(data, 10), data.aggregates[10]
+        )
+        self.assertEqual(
+            utils.COMPUTE_SECONDS.count('user_aggregates'), lookups + 1
+        )
+
+    def test_api_admin_reload(self):
+        """
+        Test forcing reload of datasets.
+        """
+        self.addCleanup(main.app.config.pop, 'ADMIN_TOKEN', None)
+        resp = self.client.post('/api/v1/admin/reload')
+        self.assertEqual(resp.status_code, 404)
+
+        main.app.config['ADMIN_TOKEN'] = b'secret'
+        resp = self.client.post(
+            '/api/v1/admin/reload', headers={'X-Admin-Token': 'wrong'}
+        )
+        self.assertEqual(resp.status_code, 403)
+        self.assertEqual(
+            self.client.get('/api/v1/admin/reload').status_code, 405
+        )
+
+        utils.get_data()
+        presence_version = utils.get_data.version()
+        users_version = utils.get_xml_data.version()
+        parsed = []
+        parse_presence_csv = loaders.parse_presence_csv
+        self.addCleanup(
+            setattr, utils, 'parse_presence_csv', parse_presence_csv
+        )
+        loaders.parse_presence_csv = lambda lines: parsed.append(lines) or (
+            parse_presence_csv(lines)
+        )
+        resp = self.client.post(
+            '/api/v1/admin/reload', headers={'X-Admin-Token': 'secret'}
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertDictEqual(
+            json.loads(resp.data), {
+                'presence_version': presence_version + 1,
+                'users_version': users_version + 1,
+            }
+        )
+        # Unchanged CSV file was parsed again as a whole.
+        self.assertEqual(len(parsed), 1)
+        with open(TEST_DATA_CSV) as csvfile:
+            self.assertEqual(parsed[0], csvfile.read().splitlines())
+
+    def test_profiling(self):
+        """
+        Test profiling requests carrying token.
+        """
+        self.addCleanup(main.app.config.pop, 'PROFILE_TOKEN', None)
+        self.addCleanup(main.app.config.pop, 'PROFILE_DIR', None)
+        url = '/api/v1/presence_weekday/10'
+        expected = self.client.get(url).data
+        resp = self.client.get(url + '?profile=secret')
+        self.assertEqual(resp.data, expected)
+
+        main.app.config['PROFILE_TOKEN'] = b'secret'
+        resp = self.client.get(url, headers={'X-Profile-Token': 'wrong'})
+        self.assertEqual(resp.data, expected)
+        resp = self.client.get(url, headers={'X-Profile-Token': 'secret'})
+        self.assertEqual(resp.content_type, 'text/plain; charset=utf-8')
+        self.assertIn('function calls', resp.data)
+        self.assertIn('dispatch_request', resp.data)
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        main.app.config['PROFILE_DIR'] = tmpdir
+        resp = self.client.get('/api/v1/export?profile=secret')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(resp.data.splitlines()), 9)
+        self.assertListEqual(
+            os.listdir(tmpdir), [resp.headers['X-Profile']]
+        )
+        self.assertTrue(resp.headers['X-Profile'].endswith(
+            '-GET-api-v1-export.prof'
+        ))
+        stats = pstats.Stats(os.path.join(tmpdir, resp.headers['X-Profile']))
+        self.assertTrue(any(
+            name == 'generate' for _, _, name in stats.stats
+        ))
+
+    def test_api_compression(self):
+        """
+        Test compressing JSON responses.
+        """
+        self.addCleanup(
+            setattr, assets, 'COMPRESS_MIN_SIZE', assets.COMPRESS_MIN_SIZE
+        )
+        assets.COMPRESS_MIN_SIZE = 200
+        url = '/api/v1/organization/start_distribution'
+        plain = self.client.get(url)
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertIn('Accept-Encoding', plain.headers['Vary'])
+
+        resp = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(
+            resp.headers['ETag'], plain.headers['ETag'][:-1] + '-gzip"'
+        )
+        self.assertEqual(
+            zlib.decompress(resp.data, 16 + zlib.MAX_WBITS), plain.data
+        )
+        resp = self.client.get(url, headers={
+            'Accept-Encoding': 'gzip', 'If-None-Match': resp.headers['ETag'],
+        })
+        self.assertEqual(resp.status_code, 304)
+        resp = self.client.get(url, headers={
+            'If-None-Match': resp.headers['ETag'],
+        })
+        self.assertEqual(resp.status_code, 200)
+        resp = self.client.get(
+            url, headers={'Accept-Encoding': 'gzip;q=0.5, deflate'}
+        )
+        self.assertEqual(resp.headers['Content-Encoding'], 'deflate')
+        self.assertEqual(zlib.decompress(resp.data), plain.data)
+
+        resp = self.client.get(
+            '/api/v1/mean_time_weekday/10', headers={'Accept-Encoding': 'gzip'}
+        )
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+        resp = self.client.get(
+            '/api/v1/export', headers={'Accept-Encoding': 'gzip'}
+        )
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(
+            zlib.decompress(resp.data, 16 + zlib.MAX_WBITS),
+            self.client.get('/api/v1/export').data,
+        )
+
+    def test_assets(self):
+        """
+        Test fingerprinted static files.
+        """
+        resp = self.client.get('/presence_weekday.html')
+        with main.app.test_request_context():
+            url = views.asset_url('js/jquery.min.js')
+            self.assertEqual(
+                views.asset_url('missing.js'), '/static/missing.js'
+            )
+        self.assertIn(url, resp.data)
+        self.assertRegexpMatches(
+            url, r'^/assets/js/jquery\.min\.[0-9a-f]{12}\.js$'
+        )
+
+        with open(os.path.join(
+                main.app.static_folder, 'js', 'jquery.min.js')) as jsfile:
+            content = jsfile.read()
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, content)
+        self.assertIn('max-age=31536000', resp.headers['Cache-Control'])
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+
+        resp = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(
+            zlib.decompress(resp.data, 16 + zlib.MAX_WBITS), content
+        )
+        resp = self.client.get(
+            url, headers={
+                'Accept-Encoding': 'gzip',
+                'If-None-Match': resp.headers['ETag'],
+            }
+        )
+        self.assertEqual(resp.status_code, 304)
+
+        image = views.ASSETS.fingerprinted('img/loading.gif')
+        resp = self.client.get(
+            '/assets/' + image, headers={'Accept-Encoding': 'gzip'}
+        )
+        self.assertEqual(resp.content_type, 'image/gif')
+        self.assertNotIn('Content-Encoding', resp.headers)
+        resp = self.client.get('/assets/js/jquery.min.0123456789ab.js')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_api_conditional_get(self):
+        """
+        Test ETag and conditional requests of JSON responses.
+        """
+        resp = self.client.get('/api/v1/presence_weekday/10')
+        etag = resp.headers['ETag']
+        self.assertIn('no-cache', resp.headers['Cache-Control'])
+        self.assertEqual(
+            resp.last_modified, utils.get_data.modified(),
+        )
+        self.assertEqual(
+            utils.get_data.modified(),
+            datetime.datetime.utcfromtimestamp(
+                int(utils.CACHE['get_data']['modified'])
+            ),
+        )
+        last_modified = resp.headers['Last-Modified']
+        utils.get_data.reload()
+        self.assertEqual(
+            self.client.get('/api/v1/presence_start_end/10').headers[
+                'Last-Modified'
+            ],
+            last_modified,
+        )
+
+        resp = self.client.get(
+            '/api/v1/presence_weekday/10',
+            headers={'If-None-Match': etag},
+        )
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, '')
+
+        resp = self.client.get(
+            '/api/v1/presence_weekday/11',
+            headers={'If-None-Match': etag},
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_jsonify_cache(self):
+        """
+        Test reusing encoded responses until data changes.
+        """
+        calls = []
+        dataset = {'version': 1}
+
+        def dependency():
+            """
+            Fake dataset function.
+            """
+
+        dependency.version = lambda: dataset['version']
+        dependency.modified = lambda: datetime.datetime(2013, 10, 1, 10)
+
+        @utils.jsonify(depends_on=(dependency,))
+        def encoded_for_test(value):
+            """
+            Counts calls.
+            """
+            calls.append(value)
+            return [value, len(calls)]
+
+        with main.app.test_request_context('/'):
+            self.assertEqual(encoded_for_test(1).data, '[1, 1]')
+            resp = encoded_for_test(1)
+            self.assertEqual(resp.data, '[1, 1]')
+            self.assertEqual(
+                resp.headers['Last-Modified'], 'Tue, 01 Oct 2013 10:00:00 GMT'
+            )
+            self.assertEqual(encoded_for_test(2).data, '[2, 2]')
+            dataset['version'] = 2
+            self.assertEqual(encoded_for_test(1).data, '[1, 3]')
+        with main.app.test_request_context('/?from=2013-01-01'):
+            self.assertEqual(encoded_for_test(1).data, '[1, 4]')
+
 
 class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
     """
@@ -86,7 +685,7 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         Test parsing of CSV file.
         """
         data = utils.get_data()
-        self.assertIsInstance(data, dict)
+        self.assertIsInstance(data, store.PresenceStore)
         self.assertItemsEqual(data.keys(), [10, 11])
         sample_date = datetime.date(2013, 9, 10)
         self.assertIn(sample_date, data[10])
@@ -96,6 +695,406 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
             datetime.time(9, 39, 5)
         )
 
+    def test_parse_presence_csv(self):
+        """
+        Test fast parsing of CSV lines.
+        """
+        users, dates, starts, ends = loaders.parse_presence_csv([
+            'user_id,date,start,end\n',
+            '10,2013-09-10,09:39:05,17:59:52\r\n',
+            '11,2013-09-11,9:19:52,16:07:37\n',
+            '12,2013-02-30,09:00:00,17:00:00\n',
+            '13,2013-09-12,25:00:00,17:00:00\n',
+            '\n',
+            'footer\n',
+        ])
+        self.assertListEqual(list(users), [10, 11])
+        self.assertListEqual(
+            list(dates),
+            [
+                datetime.date(2013, 9, 10).toordinal(),
+                datetime.date(2013, 9, 11).toordinal(),
+            ]
+        )
+        self.assertListEqual(list(starts), [34745, 33592])
+        self.assertListEqual(list(ends), [64792, 58057])
+
+    def test_parse_time(self):
+        """
+        Test parse_time.
+        """
+        self.assertEqual(loaders.parse_time('01:02:03'), 3723)
+        self.assertEqual(loaders.parse_time('1:02:03'), 3723)
+        self.assertRaises(ValueError, loaders.parse_time, '24:00:00')
+        self.assertRaises(ValueError, loaders.parse_time, '-1:00:00')
+        self.assertRaises(ValueError, loaders.parse_time, '')
+
+    def test_aggregates(self):
+        """
+        Test per-user aggregate index.
+        """
+        aggregates = utils.get_data().aggregates
+        self.assertItemsEqual(aggregates.keys(), [10, 11])
+        self.assertDictEqual(
+            aggregates[11], {
+                'weekday_count': [1, 1, 1, 2, 1, 0, 0],
+                'weekday_total': [24123, 16564, 25321, 45968, 6426, 0, 0],
+                'start_total': [33134, 33590, 33206, 71204, 47816, 0, 0],
+                'end_total': [57257, 50154, 58527, 117172, 54242, 0, 0],
+                'months': {'2013.09': 118402},
+            }
+        )
+
+    def test_totals(self):
+        """
+        Test presence of all users summed up together.
+        """
+        data = utils.get_data()
+        totals = data.totals
+        for key in ('weekday_count', 'weekday_total', 'start_total'):
+            self.assertListEqual(
+                totals[key],
+                [sum(pair) for pair in zip(
+                    data.aggregates[10][key], data.aggregates[11][key]
+                )],
+            )
+        self.assertDictEqual(totals['months'], {'2013.09': 196619})
+        self.assertIs(data.totals, totals)
+
+    def test_histogram(self):
+        """
+        Test counting values in buckets.
+        """
+        self.assertListEqual(
+            store.histogram([5, 0, 12, -1, 10, 29, 30, 31], 10, 3), [2, 2, 1]
+        )
+        self.assertListEqual(store.histogram([], 10, 2), [0, 0])
+
+    def test_chunk_boundaries(self):
+        """
+        Test splitting file into chunks of whole lines.
+        """
+        with open(TEST_DATA_CSV, 'r') as csvfile:
+            content = csvfile.read()
+            size = len(content)
+            boundaries = loaders.chunk_boundaries(csvfile, 0, size, 4)
+        self.assertEqual(boundaries[0], 0)
+        self.assertEqual(boundaries[-1], size)
+        self.assertListEqual(boundaries, sorted(set(boundaries)))
+        for position in boundaries[1:-1]:
+            self.assertEqual(content[position - 1], '\n')
+        with open(TEST_DATA_CSV, 'r') as csvfile:
+            self.assertListEqual(
+                loaders.chunk_boundaries(csvfile, 0, size, 100),
+                [0] + [
+                    i + 1 for i, char in enumerate(content) if char == '\n'
+                ] + [size],
+            )
+
+    def test_parallel_csv_parsing(self):
+        """
+        Test parsing CSV file in a pool of processes.
+        """
+        with open(SAMPLE_DATA_CSV, 'r') as csvfile:
+            expected = loaders.parse_presence_csv(csvfile.read().splitlines())
+        size = os.path.getsize(SAMPLE_DATA_CSV)
+        columns, end, offset = loaders.parse_presence_csv_parallel(
+            SAMPLE_DATA_CSV, 0, size, 3
+        )
+        self.assertTupleEqual(columns, expected)
+        self.assertEqual(end, size)
+
+        serial = loaders.PresenceCSVLoader()
+        parallel = loaders.PresenceCSVLoader()
+        serial_data = serial.load(SAMPLE_DATA_CSV)
+        parallel_data = parallel.load(SAMPLE_DATA_CSV, workers=3)
+        self.assertEqual(parallel.offset, serial.offset)
+        self.assertEqual(parallel.offset, offset)
+        self.assertEqual(parallel.size, serial.size)
+        self.assertDictEqual(parallel_data.offsets, serial_data.offsets)
+        for name in ('dates', 'starts', 'ends', 'weekdays'):
+            self.assertEqual(
+                getattr(parallel_data, name), getattr(serial_data, name)
+            )
+        self.assertDictEqual(parallel_data.aggregates, serial_data.aggregates)
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        self.assertItemsEqual(parallel.load(path, workers=2).keys(), [10, 11])
+        with open(path, 'a') as csvfile:
+            csvfile.write('\n12,2013-09-10,08:00:00,16:00:00\n12,2013-09-1')
+        data = parallel.load(path, workers=2)
+        self.assertItemsEqual(data.keys(), [10, 11, 12])
+        self.assertEqual(parallel.offset, os.path.getsize(path) - 12)
+
+        # Only warm up parses in parallel, loads by get_data never fork.
+        calls = []
+        parse_parallel = loaders.parse_presence_csv_parallel
+        self.addCleanup(
+            setattr, utils, 'parse_presence_csv_parallel', parse_parallel
+        )
+        loaders.parse_presence_csv_parallel = lambda *args: calls.append(
+            args[-1]
+        ) or parse_parallel(*args)
+        self.addCleanup(main.app.config.pop, 'CSV_WORKERS', None)
+        main.app.config['CSV_WORKERS'] = 3
+        utils.get_data.reload()
+        self.assertListEqual(calls, [])
+        utils.warm_up(reload=True, workers=3)
+        self.assertListEqual(calls, [3])
+
+    def test_metrics_render(self):
+        """
+        Test Prometheus text format of counters and histograms.
+        """
+        registry = []
+        counter = metrics.Counter(
+            'test_total', 'Test counter.', ('name',), registry=registry
+        )
+        histogram = metrics.Histogram(
+            'test_seconds', 'Test histogram.', ('name',),
+            buckets=(0.1, 1.0), registry=registry,
+        )
+        counter.inc('a"b')
+        counter.inc('a"b')
+        histogram.observe(0.05, 'x')
+        histogram.observe(0.5, 'x')
+        histogram.observe(5, 'x')
+        with histogram.time('y'):
+            pass
+        self.assertEqual(counter.value('a"b'), 2)
+        self.assertEqual(histogram.count('y'), 1)
+        self.assertEqual(
+            metrics.render(registry).splitlines()[:12], [
+                '# HELP test_total Test counter.',
+                '# TYPE test_total counter',
+                'test_total{name="a\\"b"} 2',
+                '# HELP test_seconds Test histogram.',
+                '# TYPE test_seconds histogram',
+                'test_seconds_bucket{name="x",le="0.1"} 1',
+                'test_seconds_bucket{name="x",le="1.0"} 2',
+                'test_seconds_bucket{name="x",le="+Inf"} 3',
+                'test_seconds_sum{name="x"} 5.55',
+                'test_seconds_count{name="x"} 3',
+                'test_seconds_bucket{name="y",le="0.1"} 1',
+                'test_seconds_bucket{name="y",le="1.0"} 1',
+            ]
+        )
+
+        @histogram.timed('z')
+        def timed_for_test():
+            """
+            Does nothing.
+            """
+        timed_for_test()
+        self.assertEqual(histogram.count('z'), 1)
+
+    def test_benchmark_suite(self):
+        """
+        Test synthetic data generator and benchmark results.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'data.csv')
+        rows = benchmark.generate_presence_csv(path, 3, 1, seed=1)
+        with open(path) as csvfile:
+            content = csvfile.read()
+        self.assertEqual(benchmark.generate_presence_csv(path, 3, 1, 1), rows)
+        with open(path) as csvfile:
+            self.assertEqual(csvfile.read(), content)
+        columns = loaders.parse_presence_csv(content.splitlines())
+        self.assertEqual(len(columns[0]), rows)
+        self.assertItemsEqual(set(columns[0]), [1, 2, 3])
+
+        xml_path = os.path.join(tmpdir, 'users.xml')
+        benchmark.generate_users_xml(xml_path, 3)
+        with open(xml_path) as xmlfile:
+            self.assertItemsEqual(
+                loaders.parse_users_xml(xmlfile).keys(), ['1', '2', '3']
+            )
+
+        result = benchmark.run_suite(users=3, years=1, requests=2, threads=2)
+        self.assertEqual(result['parameters']['users'], 3)
+        self.assertIn(
+            '/api/v1/presence_weekday/1', result['results']['latency']
+        )
+        self.assertGreater(result['results']['throughput'], 0)
+        self.assertEqual(main.app.config['DATA_CSV'], TEST_DATA_CSV)
+        self.assertListEqual(
+            benchmark.compare_results(result, result), []
+        )
+        slower = json.loads(json.dumps(result))
+        slower['results']['cold_load'] *= 2
+        self.assertEqual(
+            benchmark.compare_results(result, slower)[0][0], 'cold_load'
+        )
+
+    def test_csv_loader(self):
+        """
+        Test incremental loading of appended CSV rows.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'data.csv')
+        with open(path, 'w') as csvfile:
+            csvfile.write('10,2013-09-10,09:00:00,17:00:00\n')
+        loader = loaders.PresenceCSVLoader()
+        data = loader.load(path)
+        self.assertItemsEqual(data.keys(), [10])
+        self.assertIs(loader.load(path), data)
+
+        with open(path, 'a') as csvfile:
+            csvfile.write('11,2013-09-10,08:00:00,16:00:00\n11,2013-09-1')
+        data = loader.load(path)
+        self.assertItemsEqual(data.keys(), [10, 11])
+        self.assertEqual(loader.offset, 64)
+
+        with open(path, 'a') as csvfile:
+            csvfile.write(
+                '1,08:00:00,12:00:00\n'
+                '10,2013-09-10,10:00:00,17:00:00'
+            )
+        data = loader.load(path)
+        self.assertEqual(len(data[11]), 2)
+        self.assertListEqual(list(data[10].starts), [36000])
+
+        # Truncated file is read from the beginning.
+        with open(path, 'w') as csvfile:
+            csvfile.write('12,2013-09-10,09:00:00,17:00:00\n')
+        self.assertItemsEqual(loader.load(path).keys(), [12])
+
+        # Rotated file is read from the beginning.
+        rotated = os.path.join(tmpdir, 'rotated.csv')
+        with open(rotated, 'w') as csvfile:
+            csvfile.write(
+                '12,2013-09-10,09:00:00,17:00:00\n'
+                '13,2013-09-10,09:00:00,17:00:00\n'
+            )
+        os.rename(rotated, path)
+        self.assertItemsEqual(loader.load(path).keys(), [12, 13])
+
+    def test_snapshot(self):
+        """
+        Test writing and reading binary snapshot.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'data.snapshot')
+        self.assertEqual(loaders.build_snapshot(TEST_DATA_CSV, path), 9)
+
+        header, data = snapshot.read_snapshot(path)
+        expected = utils.get_data()
+        self.assertEqual(header['size'], os.path.getsize(TEST_DATA_CSV))
+        self.assertEqual(header['rows'], 9)
+        self.assertDictEqual(data.offsets, expected.offsets)
+        self.assertEqual(data.dates, expected.dates)
+        self.assertEqual(data.starts, expected.starts)
+        self.assertEqual(data.ends, expected.ends)
+        self.assertEqual(data.weekdays, expected.weekdays)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o644)
+
+        os.chmod(path, 0o664)
+        loaders.build_snapshot(TEST_DATA_CSV, path)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o664)
+
+        with open(path, 'r+b') as snapshotfile:
+            snapshotfile.write('GARBAGE!')
+        self.assertRaises(ValueError, snapshot.read_snapshot, path)
+
+    def test_replace_file(self):
+        """
+        Test replacing file, which keeps its mode.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'users.xml')
+        with snapshot.replace_file(path) as xmlfile:
+            xmlfile.write('new')
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o644)
+
+        os.chmod(path, 0o640)
+        with snapshot.replace_file(path) as xmlfile:
+            xmlfile.write('newer')
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o640)
+        with self.assertRaises(ValueError):
+            with snapshot.replace_file(path) as xmlfile:
+                raise ValueError()
+        with open(path) as xmlfile:
+            self.assertEqual(xmlfile.read(), 'newer')
+        self.assertListEqual(os.listdir(tmpdir), ['users.xml'])
+
+    def test_csv_loader_snapshot(self):
+        """
+        Test starting CSV loader from snapshot.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'data.csv')
+        snapshot_path = os.path.join(tmpdir, 'data.snapshot')
+        with open(path, 'w') as csvfile:
+            csvfile.write('10,2013-09-10,09:00:00,17:00:00\n')
+        loaders.build_snapshot(path, snapshot_path)
+
+        # Mark data in snapshot (last end, before weekdays column) to tell
+        # it apart from parsed one.
+        with open(snapshot_path, 'r+b') as snapshotfile:
+            snapshotfile.seek(-4 - 1, os.SEEK_END)
+            snapshotfile.write(snapshot.array('i', [1]).tostring())
+
+        # Rows appended after making snapshot are parsed.
+        with open(path, 'a') as csvfile:
+            csvfile.write('11,2013-09-10,08:00:00,16:00:00\n')
+        loader = loaders.PresenceCSVLoader()
+        data = loader.load(path, snapshot_path)
+        self.assertItemsEqual(data.keys(), [10, 11])
+        self.assertListEqual(list(data[10].ends), [1])
+        self.assertListEqual(list(data[11].ends), [57600])
+        self.assertEqual(loader.offset, 64)
+
+        # Snapshot of different content is ignored.
+        with open(path, 'w') as csvfile:
+            csvfile.write('12,2013-09-10,08:00:00,16:00:00\n')
+            csvfile.write('13,2013-09-10,08:00:00,16:00:00\n')
+        loader = loaders.PresenceCSVLoader()
+        data = loader.load(path, snapshot_path)
+        self.assertItemsEqual(data.keys(), [12, 13])
+
+    def test_shared_snapshot_loader(self):
+        """
+        Test sharing mapped snapshot between loaders.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'data.csv')
+        snapshot_path = os.path.join(tmpdir, 'data.snapshot')
+        shutil.copy(TEST_DATA_CSV, path)
+
+        loader = loaders.SharedSnapshotLoader()
+        data = loader.load(path, snapshot_path)
+        self.assertTrue(os.path.exists(snapshot_path))
+        self.assertItemsEqual(data.keys(), [10, 11])
+        self.assertIs(loader.load(path, snapshot_path), data)
+        self.assertNotIsInstance(data.dates, snapshot.array)
+        self.assertDictEqual(
+            utils.group_by_months(data[11]), {'2013.09': 118402}
+        )
+
+        # Other process attaches to the same snapshot.
+        other = loaders.SharedSnapshotLoader()
+        self.assertDictEqual(
+            other.load(path, snapshot_path).offsets, data.offsets
+        )
+
+        with open(path, 'a') as csvfile:
+            csvfile.write('\n12,2013-09-10,09:00:00,17:00:00\n')
+        data = loader.load(path, snapshot_path)
+        self.assertItemsEqual(data.keys(), [10, 11, 12])
+        self.assertItemsEqual(
+            other.load(path, snapshot_path).keys(), [10, 11, 12]
+        )
+
     def test_group_by_weekday(self):
         """
         Test group_by_weekday.
@@ -208,7 +1207,7 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
                 [[33134], [57257]],
                 [[33590], [50154]],
                 [[33206], [58527]],
-                [[37116, 34088], [60085, 57087]],
+                [[34088, 37116], [57087, 60085]],
                 [[47816], [54242]],
                 [[], []],
                 [[], []],
@@ -244,6 +1243,311 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
             }
         )
 
+    def test_user_presence_between(self):
+        """
+        Test slicing user's entries by date range.
+        """
+        data = utils.get_data()[11]
+        first = datetime.date(2013, 9, 6).toordinal()
+        last = datetime.date(2013, 9, 10).toordinal()
+        self.assertListEqual(
+            list(data.between(first, last)),
+            [datetime.date(2013, 9, 9), datetime.date(2013, 9, 10)],
+        )
+        self.assertEqual(len(data.between(first)), 5)
+        self.assertEqual(len(data.between(last=last)), 3)
+        self.assertEqual(len(data.between(last, first)), 0)
+
+    def test_presence_store(self):
+        """
+        Test building PresenceStore from unsorted columns.
+        """
+        day = datetime.date(2013, 9, 10).toordinal()
+        data = store.PresenceStore.from_columns(
+            [11, 10, 11, 11],
+            [day + 1, day, day, day + 1],
+            [100, 200, 300, 400],
+            [1000, 2000, 3000, 4000],
+        )
+        self.assertItemsEqual(data.keys(), [10, 11])
+        self.assertEqual(data.offsets, {10: (0, 1), 11: (1, 3)})
+        self.assertListEqual(list(data[11].dates), [day, day + 1])
+        self.assertListEqual(list(data[11].starts), [300, 400])
+        self.assertListEqual(list(data[11].weekdays), [1, 2])
+        self.assertEqual(len(data[11]), 2)
+        self.assertNotIn(datetime.date(2013, 9, 12), data[11])
+        self.assertDictEqual(
+            data[10][datetime.date(2013, 9, 10)], {
+                'start': datetime.time(0, 3, 20),
+                'end': datetime.time(0, 33, 20),
+            }
+        )
+
+    def test_presence_store_merge(self):
+        """
+        Test merging new rows into PresenceStore.
+        """
+        day = datetime.date(2013, 9, 10).toordinal()
+        data = store.PresenceStore.from_columns(
+            [10, 11, 11, 12],
+            [day, day, day + 2, day],
+            [100, 200, 300, 400],
+            [1000, 2000, 3000, 4000],
+        )
+        merged = data.merge(
+            [13, 11, 10, 11],
+            [day, day + 1, day + 1, day + 2],
+            [500, 600, 700, 800],
+            [5000, 6000, 7000, 8000],
+        )
+        expected = store.PresenceStore.from_columns(
+            *[list(old) + new for old, new in zip(data.columns(), (
+                [13, 11, 10, 11],
+                [day, day + 1, day + 1, day + 2],
+                [500, 600, 700, 800],
+                [5000, 6000, 7000, 8000],
+            ))]
+        )
+        for name in ('dates', 'starts', 'ends', 'weekdays', 'offsets'):
+            self.assertEqual(
+                getattr(merged, name), getattr(expected, name), name
+            )
+        self.assertListEqual(list(merged[11].starts), [200, 600, 800])
+        self.assertListEqual(list(data[11].starts), [200, 300])
+        self.assertIs(data.merge([], [], [], []), data)
+
+    def test_group_by_columns(self):
+        """
+        Test grouping of columnar data against grouping of plain dicts.
+        """
+        data = utils.get_data()
+        for user_id in data:
+            items = OrderedDict(
+                (date, data[user_id][date]) for date in data[user_id]
+            )
+            self.assertListEqual(
+                utils.group_by_weekday(data[user_id]),
+                utils.group_by_weekday(items),
+            )
+            self.assertListEqual(
+                utils.group_by_start_end(data[user_id]),
+                utils.group_by_start_end(items),
+            )
+            self.assertDictEqual(
+                utils.group_by_months(data[user_id]),
+                utils.group_by_months(items),
+            )
+
+    def test_cache(self):
+        """
+        Test cache decorator.
+        """
+        calls = []
+
+        @utils.cache(600)
+        def cached_for_test():
+            """
+            Counts calls.
+            """
+            calls.append(1)
+            return len(calls)
+
+        self.addCleanup(utils.CACHE.pop, 'cached_for_test', None)
+        self.assertEqual(cached_for_test(), 1)
+        self.assertEqual(cached_for_test(), 1)
+        utils.CACHE['cached_for_test']['time'] -= 601
+        self.assertEqual(cached_for_test(), 2)
+
+    def test_cache_stamp(self):
+        """
+        Test recomputing cached data when its files change.
+        """
+        calls = []
+        stamp = {'value': 1}
+
+        @utils.cache(None, stamp=lambda: stamp['value'], poll_interval=10)
+        def stamped_for_test():
+            """
+            Counts calls.
+            """
+            calls.append(1)
+            return len(calls)
+
+        self.addCleanup(utils.CACHE.pop, 'stamped_for_test', None)
+        self.assertEqual(stamped_for_test(), 1)
+        utils.CACHE['stamped_for_test']['time'] -= 10 ** 6
+        self.assertEqual(stamped_for_test(), 1)
+        stamp['value'] = 2
+        self.assertEqual(stamped_for_test(), 1)
+        utils.CACHE['stamped_for_test']['checked'] -= 10
+        self.assertEqual(stamped_for_test(), 2)
+        self.assertEqual(utils.CACHE['stamped_for_test']['stamp'], 2)
+        utils.CACHE['stamped_for_test']['checked'] -= 10
+        self.assertEqual(stamped_for_test(), 2)
+
+    def test_get_data_follows_file(self):
+        """
+        Test reloading presence data after CSV file is written.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        main.app.config.update({'DATA_CSV': path})
+        self.addCleanup(utils.get_data.reload)
+        self.addCleanup(main.app.config.update, {'DATA_CSV': TEST_DATA_CSV})
+        data = utils.get_data.reload()
+        self.assertIs(utils.get_data(), data)
+
+        with open(path, 'a') as csvfile:
+            csvfile.write('\n12,2013-09-10,08:00:00,16:00:00\n')
+        utils.CACHE['get_data']['checked'] -= 1
+        self.assertIs(utils.get_data(), data)
+        for _ in range(100):
+            if 12 in utils.get_data():
+                break
+            time.sleep(0.01)
+        self.assertIn(12, utils.get_data())
+
+    def test_cache_stale_while_revalidate(self):
+        """
+        Test returning stale data while it is recomputed in background.
+        """
+        calls = []
+        release = threading.Event()
+
+        @utils.cache(600, stale_while_revalidate=True)
+        def revalidated_for_test():
+            """
+            Counts calls, blocks all but the first one.
+            """
+            calls.append(1)
+            if len(calls) > 1:
+                release.wait()
+            return len(calls)
+
+        self.addCleanup(utils.CACHE.pop, 'revalidated_for_test', None)
+        self.assertEqual(revalidated_for_test(), 1)
+        utils.CACHE['revalidated_for_test']['time'] -= 601
+        self.assertEqual(revalidated_for_test(), 1)
+        self.assertEqual(revalidated_for_test(), 1)
+
+        release.set()
+        for _ in range(100):
+            if utils.CACHE['revalidated_for_test']['data'] == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(revalidated_for_test(), 2)
+        self.assertEqual(len(calls), 2)
+
+    def test_cache_reload_during_refresh(self):
+        """
+        Test version bumps of reload overlapping background refresh.
+        """
+        calls = []
+        release = threading.Event()
+
+        @utils.cache(600, stale_while_revalidate=True)
+        def reloaded_for_test():
+            """
+            Returns number of the call, blocks the second one.
+            """
+            calls.append(1)
+            number = len(calls)
+            if number == 2:
+                release.wait()
+            return number
+
+        self.addCleanup(utils.CACHE.pop, 'reloaded_for_test', None)
+        self.assertEqual(reloaded_for_test(), 1)
+        utils.CACHE['reloaded_for_test']['time'] -= 601
+        self.assertEqual(reloaded_for_test(), 1)
+        for _ in range(100):
+            if len(calls) == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(reloaded_for_test.reload(), 3)
+        self.assertEqual(reloaded_for_test.version(), 2)
+
+        release.set()
+        for _ in range(100):
+            if utils.CACHE['reloaded_for_test']['data'] == 2:
+                break
+            time.sleep(0.01)
+        # Every swapped dataset gets its own version.
+        self.assertEqual(reloaded_for_test.version(), 3)
+
+    def test_memoize(self):
+        """
+        Test memoize decorator.
+        """
+        calls = []
+        dataset = {'version': 1}
+
+        def dependency_version():
+            """
+            Version of fake dataset.
+            """
+            return dataset['version']
+
+        def dependency():
+            """
+            Fake dataset function.
+            """
+
+        dependency.version = dependency_version
+
+        @utils.memoize(maxsize=2, depends_on=(dependency,))
+        def memoized_for_test(value, times=1):
+            """
+            Counts calls.
+            """
+            calls.append(value)
+            return value * times
+
+        self.assertEqual(memoized_for_test(2), 2)
+        self.assertEqual(memoized_for_test(2), 2)
+        self.assertEqual(memoized_for_test(2, times=2), 4)
+        self.assertEqual(memoized_for_test(3), 3)
+        self.assertEqual(memoized_for_test(2), 2)
+        self.assertListEqual(calls, [2, 2, 3, 2])
+        self.assertDictEqual(
+            memoized_for_test.cache_info(), {
+                'hits': 1,
+                'misses': 4,
+                'evictions': 2,
+                'invalidations': 0,
+                'size': 2,
+            }
+        )
+
+        dataset['version'] = 2
+        memoized_for_test(3)
+        self.assertListEqual(calls, [2, 2, 3, 2, 3])
+        self.assertEqual(memoized_for_test.cache_info()['invalidations'], 2)
+
+        # Unhashable arguments aren't cached.
+        self.assertEqual(memoized_for_test([1]), [1])
+        self.assertEqual(memoized_for_test.cache_info()['size'], 1)
+
+    def test_memoize_ttl(self):
+        """
+        Test expiring memoized results.
+        """
+        calls = []
+
+        @utils.memoize(ttl=-1)
+        def expired_for_test():
+            """
+            Counts calls.
+            """
+            calls.append(1)
+
+        expired_for_test()
+        expired_for_test()
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(expired_for_test.cache_info()['hits'], 0)
+
     def test_get_xml_data(self):
         """
         Test get_xml_data.
@@ -264,6 +1568,390 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
             }
         )
 
+    def test_users_xml_loader(self):
+        """
+        Test reloading users xml file only when it changes.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'users.xml')
+        shutil.copy(TEST_DATA_XML, path)
+        loader = loaders.UsersXMLLoader()
+
+        directory = loader.load(path)
+        self.assertIs(loader.load(path), directory)
+        self.assertEqual(loader.current_version(), 1)
+        self.assertEqual(
+            directory.users['26']['avatar'],
+            'https://intranet.stxnext.pl/api/images/users/26'
+        )
+        self.assertListEqual(
+            [user['user_id'] for user in directory.user_list],
+            ['141', '176', '170', '26'],
+        )
+
+        with open(path, 'a') as xmlfile:
+            xmlfile.write('\n')
+        self.assertIsNot(loader.load(path), directory)
+        self.assertEqual(loader.current_version(), 2)
+
+    def test_polish_sort_key(self):
+        """
+        Test Polish collation.
+        """
+        names = [
+            'Żaneta Z.', 'Łukasz B.', 'Zenon K.', 'Ćwik A.', 'Lucyna M.',
+            'adam', 'Adam P.', 'Ania', 'Ąkowski', 'Celina', 'Adam', 'Ołek',
+            'Ósemka', '2pac', 'Émile',
+        ]
+        self.assertListEqual(
+            sorted(names, key=collation.polish_sort_key), [
+                '2pac', 'adam', 'Adam', 'Adam P.', 'Ania', 'Ąkowski',
+                'Celina', 'Ćwik A.', 'Émile', 'Lucyna M.', 'Łukasz B.',
+                'Ołek', 'Ósemka', 'Zenon K.', 'Żaneta Z.',
+            ]
+        )
+        self.assertEqual(
+            collation.polish_sort_key('Łukasz'),
+            collation.polish_sort_key('Łukasz'.encode('utf-8')),
+        )
+
+
+class SQLiteStorageTestCase(unittest.TestCase):
+    """
+    SQLite storage backend tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, import test data and switch to SQLite storage.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.path = os.path.join(tmpdir, 'data.sqlite')
+        self.rows = loaders.import_sqlite(TEST_DATA_CSV, self.path)
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'DATA_XML': TEST_DATA_XML,
+            'STORAGE': 'sqlite',
+            'DATA_SQLITE': self.path,
+        })
+        utils.get_data.reload()
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        """
+        Get back to CSV storage.
+        """
+        main.app.config.update({'STORAGE': 'csv'})
+        utils.get_data.reload()
+
+    def test_import(self):
+        """
+        Test importing CSV file.
+        """
+        self.assertEqual(self.rows, 9)
+        data = utils.get_data()
+        self.assertIsInstance(data, database.SQLitePresenceStore)
+        self.assertListEqual(data.keys(), [10, 11])
+        self.assertEqual(len(data), 2)
+        self.assertIn(10, data)
+        self.assertNotIn(9999, data)
+        self.assertRaises(KeyError, data.__getitem__, 9999)
+
+        self.assertEqual(loaders.import_sqlite(TEST_DATA_CSV, self.path), 9)
+        self.assertEqual(len(utils.get_data()[10]), 3)
+
+    def test_same_as_csv(self):
+        """
+        Test queries give the same results as the in-memory store.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'sample.sqlite')
+        loaders.import_sqlite(SAMPLE_DATA_CSV, path, batch=1000)
+        data = database.SQLitePresenceStore(path)
+        expected = loaders.PresenceCSVLoader().load(SAMPLE_DATA_CSV)
+
+        self.assertListEqual(data.keys(), sorted(expected))
+        self.assertDictEqual(data.aggregates, expected.aggregates)
+        self.assertDictEqual(data.totals, expected.totals)
+        self.assertListEqual(
+            data.start_histogram(3600, 24), expected.start_histogram(3600, 24)
+        )
+        first = datetime.date(2013, 3, 1).toordinal()
+        last = datetime.date(2013, 5, 31).toordinal()
+        for user_id in expected.keys()[:10]:
+            self.assertDictEqual(
+                data.user_aggregates(user_id, first, last),
+                expected.user_aggregates(user_id, first, last),
+            )
+            self.assertListEqual(
+                list(data[user_id].between(first).entries()),
+                list(expected[user_id].between(first).entries()),
+            )
+            self.assertEqual(
+                len(data[user_id].between(last=last)),
+                len(expected[user_id].between(last=last)),
+            )
+
+    def test_user_presence(self):
+        """
+        Test mapping interface of user's entries.
+        """
+        entries = utils.get_data()[10]
+        self.assertListEqual(
+            list(entries), [
+                datetime.date(2013, 9, 10),
+                datetime.date(2013, 9, 11),
+                datetime.date(2013, 9, 12),
+            ]
+        )
+        self.assertIn(datetime.date(2013, 9, 10), entries)
+        self.assertDictEqual(
+            entries[datetime.date(2013, 9, 10)], {
+                'start': datetime.time(9, 39, 5),
+                'end': datetime.time(17, 59, 52),
+            }
+        )
+        september = entries.between(
+            datetime.date(2013, 9, 11).toordinal(),
+            datetime.date(2013, 9, 30).toordinal(),
+        )
+        self.assertNotIn(datetime.date(2013, 9, 10), september)
+        self.assertEqual(len(september), 2)
+        self.assertEqual(september, entries.between(
+            datetime.date(2013, 9, 11).toordinal(),
+            datetime.date(2013, 9, 30).toordinal(),
+        ))
+        self.assertNotEqual(september, entries)
+        self.assertListEqual(
+            utils.group_by_weekday(entries),
+            [[], [30047], [24465], [23705], [], [], []],
+        )
+
+    def test_views(self):
+        """
+        Test views served from SQLite database.
+        """
+        resp = self.client.get('/api/v1/presence_weekday/10')
+        self.assertEqual(resp.status_code, 200)
+        self.assertListEqual(
+            json.loads(resp.data), [
+                ['Weekday', 'Presence (s)'], ['Mon', 0], ['Tue', 30047],
+                ['Wed', 24465], ['Thu', 23705], ['Fri', 0], ['Sat', 0],
+                ['Sun', 0],
+            ]
+        )
+        resp = self.client.get('/api/v1/monthly_presence/11?to=2013-09-30')
+        self.assertListEqual(
+            json.loads(resp.data),
+            [['Month', 'Presence (s)'], ['2013.09', 118402]],
+        )
+        resp = self.client.get('/api/v1/mean_time_weekday/9999')
+        self.assertEqual(json.loads(resp.data), 0)
+        resp = self.client.get('/api/v1/export?format=csv&users=10')
+        self.assertEqual(len(resp.data.splitlines()), 3)
+
+
+class UsersXMLRefresherTestCase(unittest.TestCase):
+    """
+    Users xml refresh tests against local HTTP server.
+    """
+
+    def setUp(self):
+        """
+        Before each test, start server returning test users xml.
+        """
+        with open(TEST_DATA_XML, 'r') as xmlfile:
+            self.content = xmlfile.read()
+        self.status = 200
+        self.requests = []
+        test_case = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            """
+            Serves content of the test case with ETag.
+            """
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                """
+                Answers conditional requests.
+                """
+                test_case.requests.append(dict(self.headers))
+                etag = '"{}"'.format(len(test_case.content))
+                if test_case.status != 200:
+                    self.send_error(test_case.status)
+                elif self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                else:
+                    self.send_response(200)
+                    self.send_header(b'ETag', etag)
+                    self.send_header(
+                        b'Last-Modified', b'Tue, 01 Oct 2013 10:00:00 GMT'
+                    )
+                    self.end_headers()
+                    self.wfile.write(test_case.content)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.shutdown)
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.path = os.path.join(tmpdir, 'users.xml')
+        self.loader = loaders.UsersXMLLoader()
+        self.refresher = loaders.UsersXMLRefresher(
+            'http://127.0.0.1:{}/users.xml'.format(self.server.server_port),
+            self.path,
+            timeout=5,
+            loader=self.loader,
+        )
+
+    def test_refresh(self):
+        """
+        Test conditional download of users xml.
+        """
+        self.assertTrue(self.refresher.refresh())
+        self.assertEqual(self.loader.current_version(), 1)
+        with open(self.path, 'r') as xmlfile:
+            self.assertEqual(xmlfile.read(), self.content)
+        self.assertNotIn('if-none-match', self.requests[0])
+
+        self.assertFalse(self.refresher.refresh())
+        self.assertEqual(
+            self.requests[1]['if-none-match'],
+            '"{}"'.format(len(self.content)),
+        )
+        self.assertEqual(
+            self.requests[1]['if-modified-since'],
+            'Tue, 01 Oct 2013 10:00:00 GMT',
+        )
+
+        self.content = self.content.replace('Adam P.', 'Adam Pe.')
+        self.assertTrue(self.refresher.refresh())
+        self.assertEqual(self.loader.current_version(), 2)
+        self.assertEqual(
+            self.loader.load(self.path).users['141']['user_name'], 'Adam Pe.'
+        )
+        self.assertItemsEqual(
+            os.listdir(os.path.dirname(self.path)),
+            ['users.xml', 'users.xml.validators'],
+        )
+
+    def test_refresh_errors(self):
+        """
+        Test keeping old file when download fails.
+        """
+        self.refresher.refresh()
+        self.content = '<intranet><users>'
+        self.assertRaises(Exception, self.refresher.refresh)
+        self.status = 500
+        self.assertRaises(urllib2.HTTPError, self.refresher.refresh)
+        with open(self.path, 'r') as xmlfile:
+            self.assertIn('Adam P.', xmlfile.read())
+        self.assertEqual(len(os.listdir(os.path.dirname(self.path))), 2)
+
+        os.unlink(self.path)
+        self.status = 200
+        with open(TEST_DATA_XML, 'r') as xmlfile:
+            self.content = xmlfile.read()
+        self.assertTrue(self.refresher.refresh())
+
+    def test_background_refresh(self):
+        """
+        Test refreshing in background thread.
+        """
+        self.refresher.start(0.05)
+        self.addCleanup(self.refresher.stop)
+        for _ in range(50):
+            if len(self.requests) >= 2:
+                break
+            time.sleep(0.05)
+        self.assertGreaterEqual(len(self.requests), 2)
+        self.assertEqual(self.loader.current_version(), 1)
+
+
+class PreforkServerTestCase(unittest.TestCase):
+    """
+    Pre-forking server tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, start server with two workers.
+        """
+        self.preloads = multiprocessing.Value('i', 0)
+        self.forks = multiprocessing.Value('i', 0)
+        self.server = prefork.PreforkServer(
+            self.application, '127.0.0.1', 0,
+            workers=2,
+            preload=self.preload,
+            post_fork=self.post_fork,
+        )
+        self.server.bind()
+        self.pid = os.fork()
+        if not self.pid:
+            try:
+                self.server.serve_forever()
+            finally:
+                os._exit(0)  # pylint: disable=protected-access
+        self.url = 'http://127.0.0.1:{}/'.format(self.server.address[1])
+
+    def tearDown(self):
+        """
+        Stop the server.
+        """
+        os.kill(self.pid, signal.SIGTERM)
+        os.waitpid(self.pid, 0)
+        self.server.socket.close()
+
+    def preload(self):
+        """
+        Counts preloads.
+        """
+        with self.preloads.get_lock():
+            self.preloads.value += 1
+
+    def post_fork(self):
+        """
+        Counts workers.
+        """
+        with self.forks.get_lock():
+            self.forks.value += 1
+
+    @staticmethod
+    def application(environ, start_response):
+        """
+        Responds with pid of worker.
+        """
+        start_response(b'200 OK', [(b'Content-Type', b'text/plain')])
+        return [str(os.getpid())]
+
+    def test_serving(self):
+        """
+        Test serving requests and rolling restart.
+        """
+        pids = set(urllib2.urlopen(self.url).read() for _ in range(10))
+        self.assertTrue(pids)
+        self.assertNotIn(str(self.pid), pids)
+        self.assertEqual(self.preloads.value, 1)
+        self.assertGreaterEqual(self.forks.value, len(pids))
+
+        os.kill(self.pid, signal.SIGHUP)
+        for _ in range(50):
+            if self.preloads.value == 2:
+                break
+            time.sleep(0.1)
+        self.assertEqual(self.preloads.value, 2)
+        self.assertEqual(urllib2.urlopen(self.url).getcode(), 200)
+
 
 def suite():
     """
@@ -272,6 +1960,9 @@ def suite():
     base_suite = unittest.TestSuite()
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsTestCase))
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerUtilsTestCase))
+    base_suite.addTest(unittest.makeSuite(SQLiteStorageTestCase))
+    base_suite.addTest(unittest.makeSuite(UsersXMLRefresherTestCase))
+    base_suite.addTest(unittest.makeSuite(PreforkServerTestCase))
     return base_suite
 
 
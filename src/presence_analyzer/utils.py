@@ -3,72 +3,400 @@
 Helper functions used in views.
 """
 
-import csv
 import logging
+import os
 import time
+from collections import OrderedDict
 from datetime import datetime
-from functools import wraps
+from functools import partial, wraps
+from hashlib import md5
+from itertools import compress
 from json import dumps
-from threading import Lock
-
-from flask import Response
-from lxml import etree
-
+from operator import sub
+from threading import Lock, Thread
+
+from flask import Response, request
+
+from presence_analyzer import assets, metrics
+from presence_analyzer.loaders import (
+    LOAD_SECONDS,
+    PresenceCSVLoader,
+    SQLiteLoader,
+    SharedSnapshotLoader,
+    UsersXMLLoader,
+    UsersXMLRefresher,
+)
 from presence_analyzer.main import app
+from presence_analyzer.store import (
+    UserPresence,
+    month_key,
+    sum_by_months,
+    weekday_mask,
+)
 
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
 CACHE = {}  # Container for cache decorator.
-
-
-def jsonify(function):
+# Guards version bumps of CACHE entries. Computing data isn't done under
+# it, so background refresh and reload may race only for the swap.
+CACHE_SWAP_LOCK = Lock()
+
+CACHE_LOOKUPS = metrics.Counter(
+    'presence_cache_lookups_total',
+    'Lookups of cache and memoize decorated functions.',
+    ('function', 'result'),
+)
+COMPUTE_SECONDS = metrics.Histogram(
+    'presence_compute_seconds',
+    'Time of computing results missing in cache.',
+    ('function',),
+)
+ENCODE_SECONDS = metrics.Histogram(
+    'presence_json_encode_seconds',
+    'Time of encoding JSON responses.',
+    ('endpoint',),
+)
+
+
+def jsonify(function=None, depends_on=()):
     """
     Creates a response with the JSON representation of wrapped function result.
+
+    When depends_on functions (decorated with cache) are given, encoded
+    result is kept for given arguments until data of any of them changes.
+    Responses carry ETag and Last-Modified headers and conditional
+    requests are answered with 304 Not Modified. Bodies are compressed
+    with gzip or deflate when client accepts it.
     """
+    if function is None:
+        return partial(jsonify, depends_on=depends_on)
+
+    def encode(query_string, *args, **kwargs):
+        """
+        Returns JSON representation, its ETag, time of encoding and dict
+        of its compressed variants by content-coding.
+
+        Query string is passed only to be a part of the cache key.
+        Variants are added on first request of every coding, so they are
+        kept and dropped together with the body.
+        """
+        # pylint: disable=unused-argument
+        result = function(*args, **kwargs)
+        with ENCODE_SECONDS.time(function.__name__):
+            body = dumps(result)
+        if depends_on:
+            # Time of the data, not of encoding, so that it's the same
+            # after eviction and in every worker process.
+            modified = max(
+                dependency.modified() for dependency in depends_on
+            )
+        else:
+            modified = datetime.utcnow().replace(microsecond=0)
+        return body, md5(body).hexdigest(), modified, {}
+
+    if depends_on:
+        encode = memoize(
+            maxsize=1024, depends_on=depends_on, name=function.__name__
+        )(encode)
+
     @wraps(function)
     def inner(*args, **kwargs):
         """
         This docstring will be overridden by @wraps decorator.
         """
-        return Response(
-            dumps(function(*args, **kwargs)),
-            mimetype='application/json'
+        for dependency in depends_on:
+            # Gives cached data a chance to reload before the lookup.
+            dependency()
+        body, etag, modified, variants = encode(
+            request.query_string, *args, **kwargs
         )
+        encoding = None
+        if len(body) >= assets.COMPRESS_MIN_SIZE:
+            encoding = request.accept_encodings.best_match(assets.ENCODINGS)
+        if encoding:
+            if encoding not in variants:
+                variants[encoding] = assets.compress(body, encoding)
+            body = variants[encoding]
+            # Every content-coding is a representation with its own ETag.
+            etag = '{}-{}'.format(etag, encoding)
+        response = Response(body, mimetype='application/json')
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        response.set_etag(etag)
+        response.last_modified = modified
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
     return inner
 
 
-def cache(cache_time):
+def cache(cache_time, stale_while_revalidate=False, stamp=None,
+          poll_interval=1):
     """
     Stores function data in Cache container.
+
+    Data expires after cache_time seconds, None means it never expires.
+    Stamp function, when given, describes files the data is made of (eg.
+    their size and mtime); it is called at most every poll_interval
+    seconds and data is computed again as soon as its result changes.
+
+    With stale_while_revalidate expired data is still returned while
+    a single background thread computes the new one, only the very first
+    call waits for the function.
     """
     lock = Lock()
 
     def wrapper(function):
         name = function.__name__
+        state = {'refreshing': False}
+
+        def compute():
+            """
+            Calls function and swaps its data in the container.
+            """
+            current_stamp = stamp() if stamp is not None else None
+            data = function()
+            with CACHE_SWAP_LOCK:
+                CACHE[name] = _cache_entry(
+                    name, time.time(), data, current_stamp
+                )
+
+        def refresh():
+            """
+            Recomputes data in background thread.
+            """
+            try:
+                compute()
+            except Exception:  # pylint: disable=broad-except
+                log.exception('Refreshing %s failed', name)
+            finally:
+                state['refreshing'] = False
+
+        def is_stale(entry, current_time):
+            """
+            Checks if entry has expired or its files have changed.
+            """
+            if (
+                    cache_time is not None and
+                    current_time - entry['time'] > cache_time
+            ):
+                return True
+            if (
+                    stamp is None or
+                    current_time - entry['checked'] < poll_interval
+            ):
+                return False
+            entry['checked'] = current_time
+            return stamp() != entry['stamp']
 
         @wraps(function)
         def inner(*args, **kwargs):
+            entry = CACHE.get(name)
+            if entry is not None and stale_while_revalidate:
+                if not is_stale(entry, time.time()):
+                    CACHE_LOOKUPS.inc(name, 'hit')
+                else:
+                    CACHE_LOOKUPS.inc(name, 'stale')
+                    with lock:
+                        if not state['refreshing']:
+                            state['refreshing'] = True
+                            thread = Thread(
+                                target=refresh,
+                                name='refresh-{}'.format(name),
+                            )
+                            thread.daemon = True
+                            thread.start()
+                return entry['data']
+
             current_time = time.time()
             with lock:
-                if (
-                    name not in CACHE or
-                    current_time - CACHE[name]['time'] > cache_time
-                ):
-                    CACHE[name] = {
-                        'time': current_time,
-                        'data': function()
-                    }
+                if name not in CACHE or is_stale(CACHE[name], current_time):
+                    CACHE_LOOKUPS.inc(name, 'miss')
+                    compute()
+                else:
+                    CACHE_LOOKUPS.inc(name, 'hit')
+
+            return CACHE[name]['data']
 
+        def version():
+            """
+            Returns version of cached data, which changes with the data.
+            """
+            entry = CACHE.get(name)
+            return entry['version'] if entry is not None else None
+
+        def modified():
+            """
+            Returns UTC time when data was loaded, it stays the same until
+            the data changes.
+            """
+            entry = CACHE.get(name)
+            if entry is None:
+                return None
+            return datetime.utcfromtimestamp(int(entry['modified']))
+
+        def reload():
+            """
+            Recomputes data right away, regardless of its age.
+            """
+            with lock:
+                compute()
             return CACHE[name]['data']
+
+        inner.version = version
+        inner.modified = modified
+        inner.reload = reload
         return inner
     return wrapper
 
 
-@cache(600)
+def _cache_entry(name, current_time, data, stamp=None):
+    """
+    Creates Cache container entry, bumps version when data has changed.
+    """
+    previous = CACHE.get(name)
+    if previous is None:
+        version, modified = 1, current_time
+    elif previous['data'] is data:
+        version, modified = previous['version'], previous['modified']
+    else:
+        version, modified = previous['version'] + 1, current_time
+    return {
+        'time': current_time,
+        'checked': current_time,
+        'stamp': stamp,
+        'data': data,
+        'version': version,
+        'modified': modified,
+    }
+
+
+def memoize(maxsize=128, ttl=None, depends_on=(), name=None):
+    """
+    Caches function results by its arguments.
+
+    Least recently used results are evicted when there are more than
+    maxsize of them, results older than ttl seconds are computed again.
+    All results are dropped when version of any of depends_on functions
+    (decorated with cache) changes. Calls with unhashable arguments are
+    not cached. Cached results are shared, so they mustn't be modified.
+    Lookups and computing time are recorded in metrics under given name,
+    by default name of the function.
+
+    Decorated function gets cache_info() and cache_clear() attributes.
+    """
+    def wrapper(function):
+        label = name or function.__name__
+        lock = Lock()
+        entries = OrderedDict()
+        stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+        state = {'versions': None}
+
+        @wraps(function)
+        def inner(*args, **kwargs):
+            key = (args, tuple(sorted(kwargs.items())))
+            try:
+                hash(key)
+            except TypeError:
+                return function(*args, **kwargs)
+
+            versions = tuple(dependency.version() for dependency in depends_on)
+            current_time = time.time()
+            with lock:
+                if versions != state['versions']:
+                    stats['invalidations'] += len(entries)
+                    entries.clear()
+                    state['versions'] = versions
+                entry = entries.pop(key, None)
+                if entry is not None and (
+                        ttl is None or current_time - entry[0] <= ttl):
+                    entries[key] = entry
+                    stats['hits'] += 1
+                    CACHE_LOOKUPS.inc(label, 'hit')
+                    return entry[1]
+                stats['misses'] += 1
+            CACHE_LOOKUPS.inc(label, 'miss')
+
+            with COMPUTE_SECONDS.time(label):
+                result = function(*args, **kwargs)
+            with lock:
+                if versions == state['versions']:
+                    entries[key] = (current_time, result)
+                    while len(entries) > maxsize:
+                        entries.popitem(last=False)
+                        stats['evictions'] += 1
+            return result
+
+        def cache_info():
+            """
+            Returns hits, misses, evictions, invalidations and size.
+            """
+            with lock:
+                return dict(stats, size=len(entries))
+
+        def cache_clear():
+            """
+            Drops all cached results.
+            """
+            with lock:
+                entries.clear()
+
+        inner.cache_info = cache_info
+        inner.cache_clear = cache_clear
+        return inner
+    return wrapper
+
+
+def warm_up(reload=False, workers=1):
+    """
+    Loads datasets into cache, so that first requests don't parse files.
+
+    With reload data is read again even if files haven't changed. More than
+    one worker parses CSV file in a pool of forked processes, so it may be
+    used only before the server starts any threads.
+    """
+    if reload or workers > 1:
+        load_presence(force=reload, workers=workers)
+    if reload:
+        get_data.reload()
+        XML_LOADER.load(app.config['DATA_XML'], force=True)
+    else:
+        get_data()
+        get_xml_data()
+
+
+def file_stamp(path):
+    """
+    Returns path, identity, size and mtime of file or None if it's missing.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (path, stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime)
+
+
+def data_stamp():
+    """
+    Describes files get_data() reads, so that it reloads when they change.
+    """
+    if app.config.get('STORAGE', 'csv') == 'sqlite':
+        return (file_stamp(app.config['DATA_SQLITE']),)
+    if app.config.get('SHARED_DATA'):
+        return (
+            file_stamp(app.config['DATA_CSV']),
+            file_stamp(app.config['DATA_SNAPSHOT']),
+        )
+    return (file_stamp(app.config['DATA_CSV']),)
+
+
+@cache(None, stale_while_revalidate=True, stamp=data_stamp)
+@LOAD_SECONDS.timed('presence')
 def get_data():
     """
     Extracts presence data from CSV file and groups it by user_id.
 
-    It creates structure like this:
+    Data is kept in PresenceStore, which gives access to user's entries
+    like this:
     data = {
         'user_id': {
             datetime.date(2013, 10, 1): {
@@ -81,32 +409,70 @@ def get_data():
             },
         }
     }
+
+    STORAGE config option selects the backend: 'csv' (default) loads whole
+    DATA_CSV file into memory, 'sqlite' queries DATA_SQLITE database
+    created by import_sqlite.
+
+    Data is loaded again in background within a second after its file
+    changes, until then the previous data is returned.
     """
-    data = {}
-    with open(app.config['DATA_CSV'], 'r') as csvfile:
-        presence_reader = csv.reader(csvfile, delimiter=',')
-        for i, row in enumerate(presence_reader):
-            if len(row) != 4:
-                # ignore header and footer lines
-                continue
+    return load_presence()
 
-            try:
-                user_id = int(row[0])
-                date = datetime.strptime(row[1], '%Y-%m-%d').date()
-                start = datetime.strptime(row[2], '%H:%M:%S').time()
-                end = datetime.strptime(row[3], '%H:%M:%S').time()
-            except (ValueError, TypeError):
-                log.debug('Problem with line %d: ', i, exc_info=True)
 
-            data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
+def load_presence(force=False, workers=1):
+    """
+    Loads presence data with the backend selected by STORAGE option.
+
+    With force files are read again even if they haven't changed. Workers
+    are used only by warm_up, get_data() is called from request and
+    refresh threads, which mustn't fork.
+    """
+    if app.config.get('STORAGE', 'csv') == 'sqlite':
+        return SQLITE_LOADER.load(app.config['DATA_SQLITE'], force)
 
+    if app.config.get('SHARED_DATA'):
+        data = SHARED_LOADER.load(
+            app.config['DATA_CSV'], app.config['DATA_SNAPSHOT'], workers,
+            force,
+        )
+    else:
+        data = CSV_LOADER.load(
+            app.config['DATA_CSV'], app.config.get('DATA_SNAPSHOT'), workers,
+            force,
+        )
+    # Build the index while loading, so that requests only look it up.
+    with COMPUTE_SECONDS.time('aggregates'):
+        data.aggregates  # pylint: disable=pointless-statement
     return data
 
 
+@COMPUTE_SECONDS.timed('user_aggregates')
+def user_aggregates(data, user_id, first=None, last=None):
+    """
+    Returns aggregates of user's presence from first to last date ordinal.
+
+    See PresenceStore.user_aggregates(), calls are timed in metrics.
+    """
+    return data.user_aggregates(user_id, first, last)
+
+
+CSV_LOADER = PresenceCSVLoader()
+SHARED_LOADER = SharedSnapshotLoader()
+SQLITE_LOADER = SQLiteLoader()
+
+
 def group_by_weekday(items):
     """
     Groups presence entries by weekday.
     """
+    if isinstance(items, UserPresence):
+        intervals = map(sub, items.ends, items.starts)
+        return [
+            list(compress(intervals, weekday_mask(items.weekdays, weekday)))
+            for weekday in xrange(7)
+        ]
+
     result = [[], [], [], [], [], [], []]  # one list for every day in week
     for date in items:
         start = items[date]['start']
@@ -136,10 +502,27 @@ def mean(items):
     return float(sum(items)) / len(items) if len(items) > 0 else 0
 
 
+def mean_of(total, count):
+    """
+    Calculates arithmetic mean from sum and count. Returns zero for no items.
+    """
+    return float(total) / count if count > 0 else 0
+
+
 def group_by_start_end(items):
     """
     Groups given items for start-end hours of each day of the week.
     """
+    if isinstance(items, UserPresence):
+        starts, ends, weekdays = items.starts, items.ends, items.weekdays
+        return [
+            [
+                list(compress(starts, weekday_mask(weekdays, weekday))),
+                list(compress(ends, weekday_mask(weekdays, weekday))),
+            ]
+            for weekday in xrange(7)
+        ]
+
     result = [[[], []] for i in range(7)]
     for date in items:
         start = items[date]['start']
@@ -159,30 +542,19 @@ def group_by_months(items):
 
     It creates something like this:
     result = {
-        '2013.9': 242211
-        '2013.10: 77634
+        '2013.09': 242211
+        '2013.10': 77634
     }
     """
+    if isinstance(items, UserPresence):
+        return sum_by_months(items.dates, items.starts, items.ends)
+
     result = {}
     for date in items:
         start = items[date]['start']
         end = items[date]['end']
-        time = interval(start, end)
-        if date.month < 10:
-            key = '{}.0{}'.format(
-                str(date.year),
-                str(date.month)
-            )
-        else:
-            key = '{}.{}'.format(
-                str(date.year),
-                str(date.month)
-            )
-
-        if key in result:
-            result[key] += time
-        else:
-            result[key] = time
+        key = month_key(date.year, date.month)
+        result[key] = result.get(key, 0) + interval(start, end)
 
     return result
 
@@ -193,25 +565,40 @@ def get_xml_data():
     {
         user_id : {'user_name': user_name, 'avatar': user_avatar_source}
     }
+
+    The file is parsed again only when it changes.
     """
-    xml_data = {}
+    return XML_LOADER.load(app.config['DATA_XML']).users
 
-    with open(app.config['DATA_XML'], 'r') as xmlfile:
-        tree = etree.parse(xmlfile)
-        server = tree.find('server')
-        server_data = '{}://{}'.format(
-            server.find('protocol').text,
-            server.find('host').text
-        )
 
-        users = tree.find('users')
-        users = users.findall('user')
+def get_user_list():
+    """
+    Returns users from xml file sorted by name:
+    [
+        {'user_id': user_id, 'name': user_name},
+    ]
+    """
+    return XML_LOADER.load(app.config['DATA_XML']).user_list
+
+
+XML_LOADER = UsersXMLLoader()
+get_xml_data.version = XML_LOADER.current_version
+get_xml_data.modified = XML_LOADER.current_modified
+
 
-        for user in users:
-            user_id = user.get('id')
-            user_name = user.find('name').text
-            user_avatar = user.find('avatar').text
-            avatar = '{}{}'.format(server_data, user_avatar)
-            xml_data[user_id] = {'user_name': user_name, 'avatar': avatar}
+def start_xml_refresh():
+    """
+    Refreshes DATA_XML from XML_URL every XML_REFRESH_INTERVAL seconds.
+
+    Downloads run in a background thread of current process, cached users
+    are reloaded right after the file is replaced.
+    """
+    refresher = UsersXMLRefresher(
+        app.config['XML_URL'],
+        app.config['DATA_XML'],
+        timeout=app.config.get('XML_TIMEOUT', 10),
+        loader=XML_LOADER,
+    )
+    refresher.start(app.config['XML_REFRESH_INTERVAL'])
+    return refresher
 
-    return xml_data
@@ -4,25 +4,82 @@ Defines views.
 """
 
 import calendar
-from flask import redirect, abort, url_for
-from flask.ext.mako import render_template
-from mako.exceptions import TopLevelLookupException
+import datetime
+import os
+import time
+from hmac import compare_digest
+from json import dumps
 
+from flask import Response, g, redirect, request, abort, url_for
+from flask.ext.mako import _lookup, render_template
+
+from presence_analyzer import metrics
+from presence_analyzer.assets import AssetManifest, ENCODINGS, compress_stream
+from presence_analyzer.loaders import parse_date
 from presence_analyzer.main import app
+from presence_analyzer.store import time_from_seconds
 from presence_analyzer.utils import (
     jsonify,
+    memoize,
     get_data,
-    mean,
-    group_by_weekday,
-    group_by_start_end,
+    mean_of,
     get_xml_data,
-    group_by_months
+    get_user_list,
+    user_aggregates,
+    warm_up,
 )
 
-import locale
 import logging
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
+EXPORT_FORMATS = {
+    'ndjson': (
+        'application/x-ndjson',
+        '{{"user_id": {}, "date": "{}", "start": "{}", "end": "{}"}}\n',
+    ),
+    'csv': ('text/csv', '{},{},{},{}\r\n'),
+}
+EXPORT_CHUNK = 1000
+
+ASSETS = AssetManifest(app.static_folder)
+ASSET_MAX_AGE = 365 * 24 * 3600
+
+TEMPLATE_FOLDER = os.path.join(app.root_path, app.template_folder)
+LAYOUTS = ('base.html',)  # Templates inherited by pages, not pages itself.
+PAGES = frozenset(
+    name for name in os.listdir(TEMPLATE_FOLDER)
+    if name.endswith('.html') and name not in LAYOUTS
+)
+
+REQUEST_SECONDS = metrics.Histogram(
+    'presence_request_seconds',
+    'Time of handling requests.',
+    ('endpoint', 'status'),
+)
+
+
+@app.before_request
+def start_timer():
+    """
+    Remembers when handling of request started.
+    """
+    g.request_start = time.time()
+
+
+@app.after_request
+def record_request_time(response):
+    """
+    Records time of handling request by endpoint.
+
+    Streamed responses are recorded when their generator is created.
+    """
+    start = getattr(g, 'request_start', None)
+    if start is not None:
+        REQUEST_SECONDS.observe(
+            time.time() - start, request.endpoint, response.status_code
+        )
+    return response
+
 
 @app.route('/')
 def mainpage():
@@ -36,45 +93,209 @@ def mainpage():
 def pages(page):
     """
     Renders templates.
+
+    Unknown pages are found in the set of page templates, rendered pages
+    are served from memory. In debug mode templates are rendered on every
+    request, so changes of them are visible.
     """
-    try:
+    if page not in PAGES:
+        page = '404.html'
+    if app.debug:
         return render_template(page, page=page)
-    except TopLevelLookupException:
-        return render_template('404.html')
+    return render_page(page, request.script_root)
+
+
+@memoize(maxsize=64)
+def render_page(page, script_root):
+    """
+    Renders page template.
+
+    Output depends only on the page and script root of urls in it.
+    """
+    # pylint: disable=unused-argument
+    return render_template(page, page=page)
+
+
+def compile_templates():
+    """
+    Compiles all templates.
+
+    With MAKO_MODULE_DIRECTORY set templates are compiled into modules
+    there, so workers import them instead of compiling again. Compiled
+    templates are kept by the lookup, with MAKO_FILESYSTEM_CHECKS disabled
+    they are rendered without checking files.
+    """
+    lookup = _lookup(app)
+    for name in sorted(os.listdir(TEMPLATE_FOLDER)):
+        if name.endswith('.html'):
+            lookup.get_template(name)
+
+
+def asset_url(filename):
+    """
+    Returns fingerprinted url of static file, eg. in templates:
+    ${ asset_url('css/style.css') }
+    """
+    fingerprinted = ASSETS.fingerprinted(filename)
+    if fingerprinted is None:
+        return url_for('static', filename=filename)
+    return url_for('asset_view', filename=fingerprinted)
+
+
+@app.context_processor
+def asset_helpers():
+    """
+    Makes asset_url available in templates.
+    """
+    return {'asset_url': asset_url}
+
+
+@app.route('/assets/<path:filename>', methods=['GET'])
+def asset_view(filename):
+    """
+    Serves fingerprinted static file, precompressed when client accepts it.
+
+    Content of fingerprinted url never changes, so it may be cached
+    by browsers and proxies for a year.
+    """
+    asset = ASSETS.get(filename)
+    if asset is None:
+        abort(404)
+    encoding = request.accept_encodings.best_match(asset.variants.keys())
+    response = Response(
+        asset.variants[encoding] if encoding else asset.content,
+        mimetype=asset.mimetype,
+    )
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.set_etag(
+        '{}-{}'.format(asset.digest, encoding) if encoding else asset.digest
+    )
+    response.headers['Cache-Control'] = (
+        'public, max-age={}, immutable'.format(ASSET_MAX_AGE)
+    )
+    return response.make_conditional(request)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_view():
+    """
+    Returns metrics in Prometheus text format.
+    """
+    return Response(
+        metrics.render(), mimetype='text/plain; version=0.0.4'
+    )
+
+
+@app.route('/api/v1/admin/reload', methods=['POST'])
+def reload_view():
+    """
+    Reloads presence data and users right away.
+
+    Token from ADMIN_TOKEN config option has to be sent in X-Admin-Token
+    header, without the option the endpoint is disabled.
+    """
+    token = app.config.get('ADMIN_TOKEN')
+    if not token:
+        abort(404)
+    given = request.headers.get('X-Admin-Token', '')
+    if isinstance(given, unicode):
+        given = given.encode('utf-8')
+    if not compare_digest(given, token):
+        abort(403)
+
+    warm_up(reload=True)
+    return Response(
+        dumps({
+            'presence_version': get_data.version(),
+            'users_version': get_xml_data.version(),
+        }),
+        mimetype='application/json',
+    )
 
 
 @app.route('/api/v1/users', methods=['GET'])
-@jsonify
+@jsonify(depends_on=(get_xml_data,))
 def users_view():
     """
     Users listing for dropdown.
     """
-    locale.setlocale(locale.LC_COLLATE, 'pl_PL.UTF-8')
-    data = get_xml_data()
-    data = [
-        {'user_id': key, 'name': value['user_name']}
-        for key, value in data.iteritems()
-    ]
-    sorted_data = sorted(
-        data,
-        key=lambda x: x['name'],
-        cmp=locale.strcoll,
-    )
-    return sorted_data
+    return get_user_list()
 
 
 @app.route('/api/v1/users/<int:user_id>', methods=['GET'])
-@jsonify
+@jsonify(depends_on=(get_xml_data,))
 def avatar_view(user_id):
     """
     Returns adress of user avatar.
     """
-    data = get_xml_data()
-    return data[str(user_id)]['avatar']
+    return get_xml_data()[str(user_id)]['avatar']
+
+
+def mean_time_weekday(aggregates):
+    """
+    Mean presence time grouped by weekday.
+    """
+    return [
+        (calendar.day_abbr[weekday], mean_of(total, count))
+        for weekday, (total, count) in enumerate(zip(
+            aggregates['weekday_total'], aggregates['weekday_count']
+        ))
+    ]
+
+
+def presence_weekday(aggregates):
+    """
+    Total presence time grouped by weekday.
+    """
+    result = [
+        (calendar.day_abbr[weekday], total)
+        for weekday, total in enumerate(aggregates['weekday_total'])
+    ]
+    result.insert(0, ('Weekday', 'Presence (s)'))
+    return result
+
+
+def presence_start_end(aggregates):
+    """
+    Mean start and end of presence grouped by weekday.
+    """
+    return [
+        (
+            calendar.day_abbr[weekday],
+            mean_of(start_total, count),
+            mean_of(end_total, count),
+        )
+        for weekday, (start_total, end_total, count) in enumerate(zip(
+            aggregates['start_total'],
+            aggregates['end_total'],
+            aggregates['weekday_count'],
+        ))
+    ]
+
+
+def monthly_presence(aggregates):
+    """
+    Total presence time grouped by months.
+    """
+    result = sorted(
+        [month, value] for (month, value) in aggregates['months'].items()
+    )
+    result.insert(0, ('Month', 'Presence (s)'))
+    return result
+
+
+STATISTICS = {
+    'mean_time_weekday': mean_time_weekday,
+    'presence_weekday': presence_weekday,
+    'presence_start_end': presence_start_end,
+    'monthly_presence': monthly_presence,
+}
 
 
 @app.route('/api/v1/mean_time_weekday/<int:user_id>', methods=['GET'])
-@jsonify
+@jsonify(depends_on=(get_data,))
 def mean_time_weekday_view(user_id):
     """
     Returns mean presence time of given user grouped by weekday.
@@ -83,17 +304,11 @@ def mean_time_weekday_view(user_id):
     if user_id not in data:
         return 0
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [
-        (calendar.day_abbr[weekday], mean(intervals))
-        for weekday, intervals in enumerate(weekdays)
-    ]
-
-    return result
+    return mean_time_weekday(user_aggregates(data, user_id, *date_range()))
 
 
 @app.route('/api/v1/presence_weekday/<int:user_id>', methods=['GET'])
-@jsonify
+@jsonify(depends_on=(get_data,))
 def presence_weekday_view(user_id):
     """
     Returns total presence time of given user grouped by weekday.
@@ -102,18 +317,11 @@ def presence_weekday_view(user_id):
     if user_id not in data:
         return 0
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [
-        (calendar.day_abbr[weekday], sum(intervals))
-        for weekday, intervals in enumerate(weekdays)
-    ]
-
-    result.insert(0, ('Weekday', 'Presence (s)'))
-    return result
+    return presence_weekday(user_aggregates(data, user_id, *date_range()))
 
 
 @app.route('/api/v1/presence_start_end/<int:user_id>', methods=['GET'])
-@jsonify
+@jsonify(depends_on=(get_data,))
 def presence_start_end_view(user_id):
     """
     Returns mean presence time of given
@@ -123,16 +331,11 @@ def presence_start_end_view(user_id):
     if user_id not in data:
         return 0
 
-    weekdays = group_by_start_end(data[user_id])
-    result = [
-        (calendar.day_abbr[weekday], mean(start_end[0]), mean(start_end[1]))
-        for weekday, start_end in enumerate(weekdays)
-    ]
-    return result
+    return presence_start_end(user_aggregates(data, user_id, *date_range()))
 
 
 @app.route('/api/v1/monthly_presence/<int:user_id>', methods=['GET'])
-@jsonify
+@jsonify(depends_on=(get_data,))
 def monthly_presence_view(user_id):
     """
     Returns monthly presence from the start of work.
@@ -148,11 +351,212 @@ def monthly_presence_view(user_id):
     if user_id not in data:
         return 0
 
-    months = group_by_months(data[user_id])
+    return monthly_presence(user_aggregates(data, user_id, *date_range()))
+
+
+@app.route('/api/v1/organization/<metric>', methods=['GET'])
+@jsonify(depends_on=(get_data,))
+def organization_view(metric):
+    """
+    Returns statistics of all users' presence summed up together.
+
+    Metric is one of STATISTICS names, totals come from a single pass over
+    the whole store and are kept until data changes.
+    """
+    if metric not in STATISTICS:
+        abort(404)
+    return STATISTICS[metric](get_data().totals)
+
+
+@app.route('/api/v1/organization/monthly_presence/users', methods=['GET'])
+@jsonify(depends_on=(get_data,))
+def organization_monthly_view():
+    """
+    Returns monthly presence of every user.
+
+    The result is grouped like this:
+    result = {
+        '10': [['Month', 'Presence (s)'], ['2013.09', 78217]],
+    }
+    """
+    data = get_data()
+    return dict(
+        (str(user_id), monthly_presence(aggregates))
+        for user_id, aggregates in data.aggregates.iteritems()
+    )
+
+
+@app.route('/api/v1/organization/start_distribution', methods=['GET'])
+@jsonify(depends_on=(get_data,))
+def start_distribution_view():
+    """
+    Returns number of entries of all users started in every hour of day.
+
+    The result is grouped like this:
     result = [
-        [month, value] for (month, value) in months.items()
+        ['Hour', 'Entries'],
+        ['00:00', 0],
+        ...
+        ['09:00', 123],
     ]
-    result.sort()
-    result.insert(0, ('Month', 'Presence (s)'))
-
+    """
+    counts = get_data().start_histogram(3600, 24)
+    result = [
+        ['{:02d}:00'.format(hour), count] for hour, count in enumerate(counts)
+    ]
+    result.insert(0, ('Hour', 'Entries'))
     return result
+
+
+@app.route('/api/v1/statistics', methods=['GET'])
+def statistics_view():
+    """
+    Returns statistics of many users in one response.
+
+    Query parameters are comma separated lists: 'users' of user ids or
+    'all' (default), 'metrics' of STATISTICS names (default all of them).
+    Optional 'from' and 'to' dates limit the period like in other views.
+    The result is streamed like this:
+    result = {
+        '10': {
+            'presence_weekday': [['Weekday', 'Presence (s)'], ...],
+            'monthly_presence': [['Month', 'Presence (s)'], ...],
+        },
+    }
+    Users without presence data get 0 for every metric.
+    """
+    names = split_argument('metrics') or sorted(STATISTICS)
+    if any(metric not in STATISTICS for metric in names):
+        abort(400)
+
+    first, last = date_range()
+    data = get_data()
+    user_ids = selected_users(data)
+
+    def generate():
+        """
+        Yields JSON document user by user.
+        """
+        yield '{'
+        for i, user_id in enumerate(user_ids):
+            aggregates = (
+                user_aggregates(data, user_id, first, last)
+                if user_id in data else None
+            )
+            yield '{}{}: {}'.format(
+                ', ' if i else '',
+                dumps(str(user_id)),
+                dumps(dict(
+                    (
+                        metric,
+                        STATISTICS[metric](aggregates)
+                        if aggregates is not None else 0
+                    )
+                    for metric in names
+                )),
+            )
+        yield '}'
+
+    return stream_response(generate(), 'application/json')
+
+
+@app.route('/api/v1/export', methods=['GET'])
+def export_view():
+    """
+    Streams raw presence entries.
+
+    Optional 'users', 'from' and 'to' query parameters select entries like
+    in statistics view, 'format' is 'ndjson' (default) or 'csv'. CSV rows
+    have the same columns as the source file:
+    user_id,date,start,end
+    10,2013-09-10,09:39:05,17:59:52
+
+    Entries are read from the store and sent in chunks, so memory use
+    doesn't depend on size of the export.
+    """
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        abort(400)
+    mimetype, row = EXPORT_FORMATS[export_format]
+
+    first, last = date_range()
+    data = get_data()
+    user_ids = selected_users(data)
+
+    def generate():
+        """
+        Yields formatted entries EXPORT_CHUNK rows at a time.
+        """
+        chunk = []
+        for user_id in user_ids:
+            if user_id not in data:
+                continue
+            entries = data[user_id].between(first, last).entries()
+            for ordinal, start, end in entries:
+                chunk.append(row.format(
+                    user_id,
+                    datetime.date.fromordinal(ordinal).isoformat(),
+                    time_from_seconds(start).isoformat(),
+                    time_from_seconds(end).isoformat(),
+                ))
+                if len(chunk) == EXPORT_CHUNK:
+                    yield ''.join(chunk)
+                    chunk = []
+        if chunk:
+            yield ''.join(chunk)
+
+    return stream_response(generate(), mimetype)
+
+
+def stream_response(chunks, mimetype):
+    """
+    Creates streamed response, compressed when client accepts it.
+    """
+    encoding = request.accept_encodings.best_match(ENCODINGS)
+    if encoding:
+        chunks = compress_stream(chunks, encoding)
+    response = Response(chunks, mimetype=mimetype)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def date_range():
+    """
+    Returns ordinals of 'from' and 'to' YYYY-MM-DD query parameters.
+
+    Statistics views use them to limit the period, both are optional.
+    """
+    try:
+        return tuple(
+            parse_date(request.args[name]) if name in request.args else None
+            for name in ('from', 'to')
+        )
+    except ValueError:
+        abort(400)
+
+
+def selected_users(data):
+    """
+    Returns ids from 'users' query parameter, all users of data by default.
+    """
+    users = split_argument('users')
+    if not users or users == ['all']:
+        return sorted(data)
+    try:
+        return [int(user_id) for user_id in users]
+    except ValueError:
+        abort(400)
+
+
+def split_argument(name):
+    """
+    Returns comma separated query parameter as list.
+    """
+    return [
+        value
+        for values in request.args.getlist(name)
+        for value in values.split(',')
+        if value
+    ]